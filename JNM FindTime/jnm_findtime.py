@@ -6,13 +6,17 @@ website: jnmolina.com
 description:
 	Insert Key: Inserts a key at the new time.
     Buttons: Finds time between two keys or for the playback range if there is no previous/next key.
+    Breakdown: Inserts keys at the fractions between every two keys of each anim curve of the selected objects,
+               in the selected range or playback range.
 
     import jnm_findtime;jnm_findtime.win()
 
 """
 import maya.cmds as mc
 import maya.mel as mm
+from maya import OpenMaya, OpenMayaAnim
 from functools import partial
+import bisect
 author = 'Jose N. Molina'
 version = 1
 website = 'jnmolina.com'
@@ -92,6 +96,50 @@ def createShelfButton(command, label='', name=None, description='', image=None,
     return mc.shelfButton(parent=shelfTab, label=name, command=command, imageOverlayLabel=label, image=image, annotation=description, width=32, height=32, align='center', **kwargs)
 
 
+def getSelectedChannels():
+    '''
+    Return channels that are selected in the channelbox
+    '''
+
+    if not mc.ls(sl=True):
+        return
+    gChannelBoxName = mm.eval('$temp=$gChannelBoxName')
+    sma = mc.channelBox(gChannelBoxName, query=True, sma=True)
+    ssa = mc.channelBox(gChannelBoxName, query=True, ssa=True)
+    sha = mc.channelBox(gChannelBoxName, query=True, sha=True)
+
+    channels = list()
+    if sma:
+        channels.extend(sma)
+    if ssa:
+        channels.extend(ssa)
+    if sha:
+        channels.extend(sha)
+
+    return channels
+
+
+class UndoChunk():
+    '''
+    In versions of maya before 2011, python doesn't always undo properly, so in
+    some cases we have to manage the undo queue ourselves.
+    '''
+
+    def __init__(self, force=False):
+        self.force = force
+
+    def __enter__(self):
+        '''open the undo chunk'''
+        if self.force or MAYA_VERSION < 2011:
+            self.force = True
+            mc.undoInfo(openChunk=True)
+
+    def __exit__(self, *args):
+        '''close the undo chunk'''
+        if self.force:
+            mc.undoInfo(closeChunk=True)
+
+
 # JNM scripts
 def getTime(time):
     fourth = .25
@@ -118,6 +166,17 @@ def getpbRange(*args):
     return start, end
 
 
+gPlayBackSlider = mm.eval('$temp=$gPlayBackSlider')
+
+
+# get the selected range, or the playback range if nothing is selected
+def getRange(*args):
+    if mc.timeControl(gPlayBackSlider, query=True, rangeVisible=True):
+        pbRange = mc.timeControl(gPlayBackSlider, query=True, rangeArray=True)
+        return float(pbRange[0]), float(pbRange[1])
+    return getpbRange()
+
+
 def keyExists(t):
     if mc.keyframe(query=True, time=(t,)) == None:
         return False
@@ -131,19 +190,89 @@ def getBox(*args):
         return mc.checkBox(keyInsert_box, query=True, value=True)
 
 
+# sorted key times of the selection and the playback range, cached between button presses.
+# scriptJobs and an anim curve callback clear it when the selection, keys or time range change.
+# The jobs are parented to the window when it's open, and unwatchKeyCache removes them and the
+# callbacks when the window closes or before a new scene or file is opened.
+keyCache = None
+cacheWatching = False
+cacheJobs = []
+cacheCallbacks = []
+
+
+def clearKeyCache(*args):
+    global keyCache
+    keyCache = None
+
+
+def unwatchKeyCache(*args):
+    global cacheWatching
+    cacheWatching = False
+    for job in cacheJobs:
+        if mc.scriptJob(exists=job):
+            mc.scriptJob(kill=job, force=True)
+    for callback in cacheCallbacks:
+        try:
+            OpenMaya.MMessage.removeCallback(callback)
+        except RuntimeError:
+            pass
+    del cacheJobs[:]
+    del cacheCallbacks[:]
+    clearKeyCache()
+
+
+def watchKeyCache(*args):
+    global cacheWatching
+    if cacheWatching:
+        return
+    unwatchKeyCache()
+    owner = {}
+    if mc.window('jnm_findtime_win', query=True, exists=True):
+        owner = {'parent': 'jnm_findtime_win'}
+        cacheJobs.append(mc.scriptJob(uiDeleted=('jnm_findtime_win', unwatchKeyCache)))
+    for event in ('SelectionChanged', 'ChannelBoxLabelSelected', 'playbackRangeChanged',
+                  'playbackRangeSliderChanged', 'timeUnitChanged', 'Undo', 'Redo'):
+        cacheJobs.append(mc.scriptJob(event=(event, clearKeyCache), **owner))
+    cacheCallbacks.append(
+        OpenMayaAnim.MAnimMessage.addAnimCurveEditedCallback(clearKeyCache))
+    for message in (OpenMaya.MSceneMessage.kBeforeNew, OpenMaya.MSceneMessage.kBeforeOpen):
+        cacheCallbacks.append(
+            OpenMaya.MSceneMessage.addCallback(message, unwatchKeyCache))
+    cacheWatching = True
+
+
+def getKeyCache(*args):
+    global keyCache
+    watchKeyCache()
+    if keyCache == None:
+        sel = mc.ls(sl=True)
+        keyTimes = None
+        if sel:
+            # the time slider only shows keys of the channels selected in the channel box
+            channels = getSelectedChannels()
+            if channels:
+                keyTimes = mc.keyframe(sel, attribute=channels, query=True, timeChange=True)
+            else:
+                keyTimes = mc.keyframe(sel, query=True, timeChange=True)
+        pb_start, pb_end = getpbRange()
+        keyCache = (sorted(set(keyTimes)) if keyTimes else [], pb_start, pb_end)
+    return keyCache
+
+
 def findKeys(*args):
-    pb_start, pb_end = getpbRange()
+    keyTimes, pb_start, pb_end = getKeyCache()
     now = mc.currentTime(query=True)
-    before = mc.findKeyframe(timeSlider=True, time=(
-        mc.currentTime(query=True),), which='previous')
-    after = mc.findKeyframe(timeSlider=True, time=(
-        mc.currentTime(query=True),), which='after')
-    if keyExists(now):
+    i = bisect.bisect_left(keyTimes, now)
+    if i < len(keyTimes) and keyTimes[i] == now:
         before = now
+    elif i:
+        before = keyTimes[i-1]
+    else:
+        before = pb_start
+    i = bisect.bisect_right(keyTimes, now)
+    if i < len(keyTimes):
+        after = keyTimes[i]
     else:
-        if before > now or before == now:
-            before = pb_start
-    if after < now or after == now:
         after = pb_end
     return before, after, pb_start, pb_end
 
@@ -161,11 +290,60 @@ def goTime(time, *args):
 
 def keyInsert(new_time):
     sel = mc.ls(sl=1)
-    mc.refresh(suspend=True)
-    for i in sel:
-        mc.setKeyframe(time=(new_time, new_time), insert=True)
-        mc.currentTime(new_time)
-    mc.refresh(suspend=False)
+    if sel:
+        mc.setKeyframe(sel, time=(new_time, new_time), insert=True)
+
+
+# inbetween frames at each fraction of every interval between the key times, skipping existing keys
+def getInbetweens(keyTimes, fractions):
+    frames = set()
+    for before, after in zip(keyTimes, keyTimes[1:]):
+        for t in fractions:
+            new_time = round((after - before) * t + before)
+            if before < new_time < after:
+                frames.add(new_time)
+    return sorted(frames.difference(keyTimes))
+
+
+# Breakdown: insert keys at each fraction between every pair of keys, for every anim curve of the
+# selected objects in the selected or playback range. Curves that get the same frames are keyed in one call.
+def breakdownKeys(times, *args):
+    sel = mc.ls(sl=True)
+    if not sel:
+        return
+    curves = mc.keyframe(sel, query=True, name=True)
+    if not curves:
+        return
+    start, end = getRange()
+    fractions = [getTime(t) for t in times]
+    # the key times of every curve come back in one list, and index values start over at 0 for each curve
+    allTimes = mc.keyframe(curves, query=True, timeChange=True) or []
+    starts = [i for i, x in enumerate(
+        mc.keyframe(curves, query=True, indexValue=True) or []) if x == 0]
+    starts.append(len(allTimes))
+    plan = []
+    grouped = {}
+    for i, curve in enumerate(curves):
+        curveTimes = allTimes[starts[i]:starts[i + 1]]
+        keyTimes = curveTimes[bisect.bisect_left(curveTimes, start):bisect.bisect_right(curveTimes, end)]
+        if not keyTimes:
+            continue
+        frames = tuple(getInbetweens(keyTimes, fractions))
+        if not frames:
+            continue
+        if frames not in grouped:
+            grouped[frames] = []
+            plan.append((frames, grouped[frames]))
+        grouped[frames].append(curve)
+    if not plan:
+        return
+    with UndoChunk(force=True):
+        mc.refresh(suspend=True)
+        try:
+            for frames, frameCurves in plan:
+                mc.setKeyframe(frameCurves, time=list(frames), insert=True)
+        finally:
+            mc.refresh(suspend=False)
 
 
 def about(*args):
@@ -189,12 +367,16 @@ half_anno = 'Find time 1/2 between two keys.'
 twothirds_anno = 'Find time 2/3 between two keys.'
 threefourths_anno = 'Find time 3/4 between two keys.'
 keyInsert_box_anno = 'Insert key at new time.'
+breakdown_halves_anno = 'Insert keys 1/2 between every two keys of the selected objects.'
+breakdown_thirds_anno = 'Insert keys 1/3 and 2/3 between every two keys of the selected objects.'
+breakdown_fourths_anno = 'Insert keys 1/4, 1/2 and 3/4 between every two keys of the selected objects.'
 
 w = 315
 
 def win(*args):
     if mc.window('jnm_findtime_win', q=True, ex=True):
         mc.deleteUI('jnm_findtime_win')
+    unwatchKeyCache()
 
     mc.window('jnm_findtime_win', title='JNM Find Time',
               resizeToFitChildren=True, height=50, width=w, menuBar=True)
@@ -228,6 +410,21 @@ def win(*args):
     popUpShelfBtn(threefourths_btn, '3/4', threefourths_anno,
                   'goTime(\'threefourths\')')
     mc.setParent('..')
+    mc.separator(style='single', horizontal=True, h=10)
+    mc.rowColumnLayout(numberOfRows=1)
+    halves_btn = mc.button(label='Breakdown 1/2', command=partial(
+        breakdownKeys, ('half',)), annotation=breakdown_halves_anno, w=w/3)
+    popUpShelfBtn(halves_btn, 'bd2', breakdown_halves_anno,
+                  'breakdownKeys((\'half\',))')
+    thirds_btn = mc.button(label='Breakdown 1/3', command=partial(
+        breakdownKeys, ('third', 'twothirds')), annotation=breakdown_thirds_anno, w=w/3)
+    popUpShelfBtn(thirds_btn, 'bd3', breakdown_thirds_anno,
+                  'breakdownKeys((\'third\',\'twothirds\'))')
+    fourths_btn = mc.button(label='Breakdown 1/4', command=partial(
+        breakdownKeys, ('fourth', 'half', 'threefourths')), annotation=breakdown_fourths_anno, w=w/3)
+    popUpShelfBtn(fourths_btn, 'bd4', breakdown_fourths_anno,
+                  'breakdownKeys((\'fourth\',\'half\',\'threefourths\'))')
+    mc.setParent('..')
     mc.columnLayout(adj=True)
     mc.helpLine()
     mc.showWindow()
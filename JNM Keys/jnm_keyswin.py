@@ -41,6 +41,11 @@ website = 'https://jnmolina.wordpress.com/tools'
 import maya.cmds as mc
 import maya.mel as mm
 from maya import OpenMaya
+import bisect
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # uses Morgan Loomis' ml_utilities http://morganloomis.com/tool/ml_utilities/
 import ml_utilities as ml
@@ -99,19 +104,15 @@ def keyExists(t,channel=None):
         else:
             return True
 
-# get frames that have keyframes
+# get the sorted key times of the selection, or of a channel, in one query
+def getKeyIndex(channel=None):
+    if channel != None :
+        return ml.KeyIndex(at=channel)
+    return ml.KeyIndex()
+
+# get frames that have keyframes, including sub-frames
 def getKeysInRange(start,end,channel=None):
-    keys = []
-    mc.refresh(suspend=True)
-    for x in range(int(start),int(end)):
-        if channel != None :
-            if keyExists(x,channel):
-                keys.append(int(x))
-        else:
-            if keyExists(x):
-                keys.append(int(x))
-    mc.refresh(suspend=False)
-    return keys
+    return getKeyIndex(channel).inRange(start,end)
 
 # check if timeline range is selected
 def checkRangeSelected(*args):
@@ -127,193 +128,325 @@ def keyCount(*args):
 
 # Move timeline keys
 def moveKey(time,new_time,option,channel=None):
-        mc.refresh(suspend=True)
         if channel != None :
-            mc.keyframe(edit=True,time=(time,),option=option,timeChange=int(new_time),at=channel)
+            mc.keyframe(edit=True,time=(time,),option=option,timeChange=new_time,at=channel)
         else:
-            mc.keyframe(edit=True,time=(time,),option=option,timeChange=int(new_time))
-        mc.refresh(suspend=False)
+            mc.keyframe(edit=True,time=(time,),option=option,timeChange=new_time)
 
 # Move selected keys in Graph Editor
 def moveSelectedKeys(step):
-        mc.refresh(suspend=True)
         mc.keyframe(edit=True,animation='keysOrObjects',option='move',relative=True,timeChange=int(step))
-        mc.refresh(suspend=False)
 
-# Move keyframes by value selected
+# Move the keys in the range as one block, checked against the channel's other keys in memory
+def moveKeyBlock(start,end,offset,channel=None):
+    keyIndex = getKeyIndex(channel)
+    keys = keyIndex.inRange(start,end)
+    if not keys:
+        return
+    for k in keys:
+        new_time = k + offset
+        if keyIndex.keyAt(new_time) and not keys[0] <= new_time <= keys[-1]:
+            displayWarning('Unable to move keys.')
+            return
+    if channel != None :
+        mc.keyframe(edit=True,time=(keys[0],keys[-1]),option='over',relative=True,timeChange=offset,at=channel)
+    else:
+        mc.keyframe(edit=True,time=(keys[0],keys[-1]),option='over',relative=True,timeChange=offset)
+    return keys[-1] + offset
+
+# Move keyframes by value selected, as one undo step
 def moveKeys(direction):
-    start = None
-    end = None
-    new_time = None
-    try:
-        step = getStepTime()
-    except:
-        step = 1
-    if objSelected():
-        if keyCount() != None:
-            if direction == 'right':
-                moveSelectedKeys(step)
-            elif direction == 'left':
-                moveSelectedKeys('-'+str(step))
-        else:
-            channels = ml.getSelectedChannels()
-            if len(channels) > 0:
-                if checkRangeSelected():
-                    start, end = getSeletedRange(start,end)
-                    for c in channels:
-                        keys = getKeysInRange(start,end,channel=c)
-                        for k in keys: # frames with keys
-                            if direction == 'right':
-                                new_time = k + step
-                            elif direction == 'left':
-                                new_time = k - step
+    with ml.Transaction():
+        start = None
+        end = None
+        new_time = None
+        try:
+            step = getStepTime()
+        except:
+            step = 1
+        if objSelected():
+            if keyCount() != None:
+                if direction == 'right':
+                    moveSelectedKeys(step)
+                elif direction == 'left':
+                    moveSelectedKeys('-'+str(step))
+            else:
+                offset = step
+                if direction == 'left':
+                    offset = -step
+                channels = ml.getSelectedChannels()
+                if len(channels) > 0:
+                    if checkRangeSelected():
+                        start, end = getSeletedRange(start,end)
+                        for c in channels:
+                            block_time = moveKeyBlock(start,end,offset,channel=c)
+                            if block_time != None:
+                                new_time = block_time
+                        if new_time != None:
+                            mc.currentTime(new_time)
+                    else:
+                        time = getTime()
+                        if direction == 'right':
+                            new_time = time + step
+                        elif direction == 'left':
+                            new_time = time - step
+                        for c in channels:
                             if not mc.keyframe(query=True,time=(new_time,),at=c):
-                                moveKey(k,new_time,option='over',channel=c)
+                                moveKey(time,new_time,option='over',channel=c)
                             else:
                                 displayWarning('Unable to move keys.')
-                    mc.currentTime(new_time)
+                        mc.currentTime(new_time)
                 else:
-                    time = getTime()
-                    if direction == 'right':
-                        new_time = time + step
-                    elif direction == 'left':
-                        new_time = time - step
-                    for c in channels:
-                        if not mc.keyframe(query=True,time=(new_time,),at=c):
-                            moveKey(time,new_time,option='over',channel=c)
-                        else:
-                            displayWarning('Unable to move keys.')
-                    mc.currentTime(new_time)
-            else:
-                if checkRangeSelected():
-                    start, end = getSeletedRange(start,end)
-                    keys = keys = getKeysInRange(start,end)
-                    for k in keys: # frames with keys
+                    if checkRangeSelected():
+                        start, end = getSeletedRange(start,end)
+                        new_time = moveKeyBlock(start,end,offset)
+                        if new_time != None:
+                            mc.currentTime(new_time)
+                    else:
+                        time = getTime()
                         if direction == 'right':
-                            new_time = k + step
+                            new_time = time + step
                         elif direction == 'left':
-                            new_time = k - step
+                            new_time = time - step
                         if not mc.keyframe(query=True,time=(new_time,)):
-                            moveKey(k,new_time,option='over')
+                            moveKey(time,new_time,option='over')
                         else:
                             displayWarning('Unable to move keys.')
-                    mc.currentTime(new_time)
-                else:
-                    time = getTime()
-                    if direction == 'right':
-                        new_time = time + step
-                    elif direction == 'left':
-                        new_time = time - step
-                    if not mc.keyframe(query=True,time=(new_time,)):
-                        moveKey(time,new_time,option='over')
-                    else:
-                        displayWarning('Unable to move keys.')
-                    mc.currentTime(new_time)
+                        mc.currentTime(new_time)
+        else:
+            displayWarning('Nothing selected.')
+
+# map each key in the range to its re-timed slot, stepping from the first key
+def getRetimeMap(keys,step):
+    return [(k,keys[0]+i*step) for i,k in enumerate(keys)]
+
+# group keys that shift by the same amount into runs, ordered so no key lands on one that hasn't moved yet
+# keys moving left go first to last, keys moving right go last to first
+def getRetimeMoves(retimeMap):
+    runs = []
+    for old,new in retimeMap:
+        offset = new - old
+        if runs and abs(runs[-1][2]-offset) < 0.0001:
+            runs[-1][1] = old
+        else:
+            runs.append([old,old,offset])
+    left = [tuple(r) for r in runs if r[2] < -0.0001]
+    right = [tuple(r) for r in reversed(runs) if r[2] > 0.0001]
+    return left + right
+
+# same as getRetimeMoves, for every channel's keys in one vectorized pass
+def getRetimeMovesArray(keyLists,step):
+    counts = np.array([len(k) for k in keyLists],dtype=int)
+    times = np.array([t for k in keyLists for t in k],dtype=float)
+    moves = [[] for k in keyLists]
+    if not len(times):
+        return moves
+    owner = np.repeat(np.arange(len(keyLists)),counts)
+    first = np.repeat(np.cumsum(counts)-counts,counts)
+    rank = np.arange(len(times)) - first
+    offsets = times[first] + rank*step - times
+    # a run starts on each channel's first key, or wherever the offset changes
+    breaks = np.ones(len(times),dtype=bool)
+    breaks[1:] = (owner[1:] != owner[:-1]) | (np.abs(np.diff(offsets)) >= 0.0001)
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:],len(times)) - 1
+    for o,first_time,last_time,offset in zip(owner[starts],times[starts],times[ends],offsets[starts]):
+        moves[o].append((float(first_time),float(last_time),float(offset)))
+    for i,runs in enumerate(moves):
+        left = [r for r in runs if r[2] < -0.0001]
+        right = [r for r in reversed(runs) if r[2] > 0.0001]
+        moves[i] = left + right
+    return moves
+
+# keys after the range stay put, so nothing can be re-timed onto them
+def retimeCollides(keyIndex,keys,step,end):
+    for t in keyIndex.inRange(end,keys[0]+len(keys)*step):
+        i = (t-keys[0])/float(step)
+        if abs(i-round(i)) < 0.0001:
+            return True
+    return False
+
+# plan the re-time for every channel from one key query each,
+# channels that end up with the same moves are grouped so they're edited together
+def planRetime(start,end,step,channels=None):
+    if not channels:
+        channels = [None]
+    keyIndexes = [getKeyIndex(c) for c in channels]
+    keyLists = [k.inRange(start,end) for k in keyIndexes]
+    if np is None:
+        moves = [getRetimeMoves(getRetimeMap(k,step)) if k else [] for k in keyLists]
     else:
-        displayWarning('Nothing selected.')
-
-# Re-time keys from first key by value selected
-def retimeSelectedKeys(*args):
-    start = None
-    end = None
+        moves = getRetimeMovesArray(keyLists,step)
+    plan = []
+    groups = {}
     new_time = None
-    step = getStepTime()
-    if keyCount() != None:
-        displayWarning('Unable to re-time curves. Please select a channel and re-time on the timeline.')
-    else:
-        channels = ml.getSelectedChannels()
-        if len(channels) != 0:
-            if checkRangeSelected():
-                start, end = getSeletedRange(start,end)
-                for c in channels:
-                    keys = getKeysInRange(start,end,channel=c)
-                    first_key = keys[0]
-                    new_time = first_key
-                    # first move keys out of the way
-                    temp_keys = []
-                    for k in keys:
-                        temp_time = k + 1000
-                        temp_keys.append(temp_time)
-                        moveKey(k,temp_time,option='over',channel=c)
-                    # retime keys from first key by value selected
-                    new_time = first_key
-                    for k in temp_keys:
-                        moveKey(k,new_time,option='over',channel=c)
-                        new_time += step
-                else:
-                    displayWarning('No keys on the timeline selected.')
+    for c,keyIndex,keys,m in zip(channels,keyIndexes,keyLists,moves):
+        if not keys:
+            continue
+        if retimeCollides(keyIndex,keys,step,end):
+            displayWarning('Unable to re-time keys.')
+            continue
+        new_time = keys[0] + len(keys)*step
+        if not m:
+            continue
+        m = tuple(m)
+        if m not in groups:
+            groups[m] = []
+            plan.append((groups[m],m))
+        groups[m].append(c)
+    return plan, new_time
+
+# apply the moves with one relative keyframe edit per run, on all channels that share them
+def applyRetimeMoves(moves,channels=None):
+    for first,last,offset in moves:
+        if channels and channels != [None]:
+            mc.keyframe(edit=True,time=(first,last),option='over',relative=True,timeChange=offset,at=channels)
+        else:
+            mc.keyframe(edit=True,time=(first,last),option='over',relative=True,timeChange=offset)
+
+# apply the whole plan with one setAttr per curve, writing the new times over each curve's moved keys.
+# the keys of every curve are fetched together, and a curve whose keys would pass over keys
+# outside the range falls back to relative moves, so maya can reorder them
+def applyRetimePlan(plan):
+    curves = []
+    curveMoves = []
+    for channels,moves in plan:
+        if channels and channels != [None]:
+            found = mc.keyframe(query=True,name=True,at=channels)
+        else:
+            found = mc.keyframe(query=True,name=True)
+        for curve in found or []:
+            curves.append(curve)
+            curveMoves.append(moves)
+    if not curves:
+        return
+    # times and values come back interleaved, and index values start over at 0 for each curve
+    data = mc.keyframe(curves,query=True,timeChange=True,valueChange=True) or []
+    starts = [i for i,x in enumerate(mc.keyframe(curves,query=True,indexValue=True) or []) if x == 0]
+    if len(starts) != len(curves):
+        for channels,moves in plan:
+            applyRetimeMoves(moves,channels=channels)
+        return
+    starts.append(len(data)//2)
+    for i,(curve,moves) in enumerate(zip(curves,curveMoves)):
+        times = data[starts[i]*2:starts[i+1]*2:2]
+        values = data[starts[i]*2+1:starts[i+1]*2:2]
+        runs = sorted(moves)
+        firsts = [first for first,last,offset in runs]
+        newTimes = list(times)
+        for k,t in enumerate(times):
+            j = bisect.bisect_right(firsts,t+0.0001) - 1
+            if j >= 0 and t <= runs[j][1]+0.0001:
+                newTimes[k] = t + runs[j][2]
+        changed = [k for k,t in enumerate(times) if newTimes[k] != t]
+        if not changed:
+            continue
+        if any(b <= a for a,b in zip(newTimes,newTimes[1:])):
+            for first,last,offset in moves:
+                mc.keyframe(curve,edit=True,time=(first,last),option='over',relative=True,timeChange=offset)
+            continue
+        keyTimeValue = []
+        for k in range(changed[0],changed[-1]+1):
+            keyTimeValue.extend((newTimes[k],values[k]))
+        mc.setAttr(curve+'.keyTimeValue['+str(changed[0])+':'+str(changed[-1])+']',*keyTimeValue)
+
+# Re-time keys from first key by value selected, as one undo step
+def retimeSelectedKeys(*args):
+    with ml.Transaction():
+        start = None
+        end = None
+        new_time = None
+        step = getStepTime()
+        if keyCount() != None:
+            displayWarning('Unable to re-time curves. Please select a channel and re-time on the timeline.')
         else:
+            channels = ml.getSelectedChannels()
             if checkRangeSelected():
                 start, end = getSeletedRange(start,end)
-                keys = getKeysInRange(start,end)
-                first_key = keys[0]
-                new_time = first_key
-                # first move keys out of the way
-                temp_keys = []
-                for k in keys:
-                    temp_time = k + 1000
-                    temp_keys.append(temp_time)
-                    moveKey(k,temp_time,option='over')
-                # retime keys from first key by value selected
-                new_time = first_key
-                for k in temp_keys:
-                    moveKey(k,new_time,option='over')
-                    new_time += step
+                plan, new_time = planRetime(start,end,step,channels)
+                applyRetimePlan(plan)
             else:
                 displayWarning('No keys on the timeline selected.')
-        mc.currentTime(new_time)
+            if new_time != None:
+                mc.currentTime(new_time)
+
+# get the anim layer to key on, None if more than one is selected
+def getKeyLayer(*args):
+    animlayers = ml.getSelectedAnimLayers()
+    if len(animlayers) > 1:
+        displayWarning('Please select only one anim layer.')
+        return None
+    if animlayers:
+        return animlayers[0]
+    if mc.animLayer('BaseAnimation',query=True,exists=True):
+        return 'BaseAnimation'
+    return ''
+
+# insert all the frames of a plan at once, channels that share the same frames are keyed together
+def insertKeys(plan,anim_layer=''):
+    for times,plugs in plan:
+        if anim_layer == '':
+            mc.setKeyframe(plugs,insert=True,time=list(times))
+        else:
+            mc.setKeyframe(plugs,insert=True,time=list(times),animLayer=anim_layer)
 
+# Set keys every step frames between the selected keys, as one undo step
 def setKeysBy(*args):
-    attr = None
-    anim_layer = ''
-    if objSelected():
-        if keyCount() != None:
-            keyCurve = mc.keyframe(query=True, name=True)
-            for kc in keyCurve:
-                keyTimes = mc.keyframe(kc,query=True,selected=True)
-                sel, attr = ml.getChannelFromAnimCurve(kc).split('.')
-                start = int(keyTimes[0])
-                end = int(keyTimes[-1])
+    with ml.Transaction():
+        if objSelected():
+            if keyCount() != None:
+                anim_layer = getKeyLayer()
+                if anim_layer == None:
+                    return
                 step = getStepTime()
-                animlayers =  ml.getSelectedAnimLayers()
-                if len(animlayers) > 1:
-                    displayWarning('Please select only one anim layer.')
-                else:
-                    if animlayers:
-                        anim_layer = animlayers[0]
-                    else:
-                        if mc.animLayer('BaseAnimation',query=True,exists=True):
-                            anim_layer = 'BaseAnimation'
-                        else:
-                            anim_layer = ''
-                for x in range(start, end, step):
-                    if anim_layer == '':
-                        mc.setKeyframe(insert=True,t=x,attribute=attr)
-                    else:
-                        mc.setKeyframe(insert=True,t=x,attribute=attr,animLayer=anim_layer)
+                plan = []
+                frames = {}
+                keyCurve = mc.keyframe(query=True, name=True)
+                for kc in keyCurve:
+                    keyTimes = mc.keyframe(kc,query=True,selected=True)
+                    if not keyTimes:
+                        continue
+                    times = tuple(range(int(keyTimes[0]),int(keyTimes[-1]),step))
+                    if not times:
+                        continue
+                    if times not in frames:
+                        frames[times] = []
+                        plan.append((times,frames[times]))
+                    frames[times].append(kc)
+                # resolve every curve's channel in one pass
+                curves = [kc for times,kcs in plan for kc in kcs]
+                channels = dict(zip(curves,ml.getChannelsFromAnimCurves(curves)))
+                # skip curves that aren't connected to a channel
+                plan = [(times,[channels[kc] for kc in kcs if channels[kc]]) for times,kcs in plan]
+                plan = [(times,plugs) for times,plugs in plan if plugs]
+                insertKeys(plan,anim_layer)
+            else:
+                displayWarning('No keys selected.')
+
+# group sorted key indices into (first, last) ranges for selectKey
+def getIndexRanges(indices):
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i-1:
+            ranges[-1][1] = i
         else:
-            displayWarning('No keys selected.')
+            ranges.append([i,i])
+    return [tuple(r) for r in ranges]
 
+# Select every step key of the selected keys, on every selected curve
 def selectKeysBy(*args):
-    attr = None
-    step = getStepTime()
     if objSelected():
         if keyCount() != None:
+            step = getStepTime()
+            plan = []
             keyCurve = mc.keyframe(query=True, name=True)
-            if len(keyCurve) > 1:
-                displayWarning('Please select only one anim curve.')
-            else:
-                for kc in keyCurve:
-                    keyTimes = mc.keyframe(kc,query=True,selected=True)
-                    sel, attr = ml.getChannelFromAnimCurve(kc).split('.')
-                    start = int(keyTimes[0])
-                    end = int(keyTimes[-1])
-                    step = getStepTime()
-                    mc.selectKey(clear=True)
-                    c = 0
-                    while c < len(keyTimes):
-                    	mc.selectKey(sel, keyframe=True, time=(keyTimes[c], keyTimes[c]), attribute=attr, add=True)
-                    	c = c+step
+            for kc in keyCurve:
+                indices = mc.keyframe(kc,query=True,selected=True,indexValue=True)
+                if indices:
+                    plan.append((kc,getIndexRanges(sorted(indices)[::step])))
+            mc.selectKey(clear=True)
+            for kc,ranges in plan:
+                mc.selectKey(kc,keyframe=True,index=ranges,add=True)
         else:
             displayWarning('No keys selected.')
 
@@ -65,8 +65,16 @@ __revision__ = 35
 import maya.cmds as mc
 import maya.mel as mm
 from maya import OpenMaya
+from maya.api import OpenMaya as om2
+from maya.api import OpenMayaAnim as oma2
 from functools import partial
-import shutil, os, re, sys, math
+import shutil, os, re, sys, math, bisect
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 #declare some variables
 WEBSITE_URL = 'http://morganloomis.com'
@@ -371,32 +379,109 @@ def frameRange(start=None, end=None):
 def getChannelFromAnimCurve(curve, plugs=True):
     '''
     Finding the channel associated with a curve has gotten really complicated since animation layers.
-    This is a recursive function which walks connections from a curve until an animated channel is found.
+    This walks connections from a curve until an animated channel is found.
     '''
+    return getChannelsFromAnimCurves([curve], plugs=plugs)[0]
+
+
+#curve to channel results, cleared whenever a connection is made or broken, or a node is deleted or renamed
+_channelMemo = dict()
+_channelMemoCallbacks = list()
+
+def clearChannelMemo(*args):
+    _channelMemo.clear()
 
 
-    #we need to save the attribute for later.
-    attr = ''
-    if '.' in curve:
-        curve, attr = curve.split('.')
+def unwatchChannelMemo(*args):
+    '''
+    Removes the memo callbacks and clears it, this runs before a new scene or file is opened.
+    '''
+    for callback in _channelMemoCallbacks:
+        try:
+            OpenMaya.MMessage.removeCallback(callback)
+        except RuntimeError:
+            pass
+    del _channelMemoCallbacks[:]
+    clearChannelMemo()
+
+
+def _watchChannelMemo():
+    if _channelMemoCallbacks:
+        return
+    _channelMemoCallbacks.append(OpenMaya.MDGMessage.addConnectionCallback(clearChannelMemo))
+    _channelMemoCallbacks.append(OpenMaya.MDGMessage.addNodeRemovedCallback(clearChannelMemo, 'dependNode'))
+    _channelMemoCallbacks.append(OpenMaya.MNodeMessage.addNameChangedCallback(OpenMaya.MObject(), clearChannelMemo))
+    for message in (OpenMaya.MSceneMessage.kBeforeNew, OpenMaya.MSceneMessage.kBeforeOpen):
+        _channelMemoCallbacks.append(OpenMaya.MSceneMessage.addCallback(message, unwatchChannelMemo))
+
+
+def getChannelsFromAnimCurves(curves, plugs=True):
+    '''
+    Returns the animated channel for each curve in a list, in the same order, or None where there isn't one.
+    Animation layer blend nodes are walked breadth first, with one connection query for each level of the graph.
+    Results are memoized until the graph changes.
+    '''
 
-    nodeType = mc.nodeType(curve)
-    if nodeType.startswith('animCurveT') or nodeType.startswith('animBlendNode'):
-        source = mc.listConnections(curve+'.output', source=False, plugs=plugs)
-        if not source and nodeType=='animBlendNodeAdditiveRotation':
-            #if we haven't found a connection from .output, then it may be a node that uses outputX, outputY, etc.
-            #get the proper attribute by using the last letter of the input attribute, which should be X, Y, etc.
-            #if we're not returning plugs, then we wont have an attr suffix to use, so just use X.
-            attrSuffix = 'X'
-            if plugs:
-                attrSuffix = attr[-1]
+    _watchChannelMemo()
 
-            source = mc.listConnections(curve+'.output'+attrSuffix, source=False, plugs=plugs)
-        if source:
-            nodeType = mc.nodeType(source[0])
+    result = [None]*len(curves)
+    #curves passed in more than once are only walked once
+    first = dict()
+    #walk the plugs of every curve that isn't memoized yet, as index, node, attr, node type
+    frontier = list()
+    for i,c in enumerate(curves):
+        if c in first:
+            continue
+        if (c, plugs) in _channelMemo:
+            first[c] = i
+            result[i] = _channelMemo[(c, plugs)]
+            continue
+        first[c] = i
+        node, _, attr = c.partition('.')
+        frontier.append((i, node, attr, None))
+
+    while frontier:
+        #one query for the whole level, only the first connection of each plug is used
+        destinations = dict()
+        connections = mc.listConnections(list(set(n+'.output' for i,n,a,t in frontier)), source=False, plugs=True, connections=True) or []
+        for j in range(0, len(connections), 2):
+            destinations.setdefault(connections[j], connections[j+1])
+
+        #if we haven't found a connection from .output, then it may be a node that uses outputX, outputY, etc.
+        #get the proper attribute by using the last letter of the input attribute, which should be X, Y, etc.
+        sources = list()
+        for i,n,a,t in frontier:
+            if n+'.output' not in destinations and t == 'animBlendNodeAdditiveRotation':
+                sources.append(n+'.output'+(a[-1] if a else 'X'))
+            else:
+                sources.append(n+'.output')
+        missing = list(set(x for x in sources if x not in destinations and not x.endswith('.output')))
+        if missing:
+            connections = mc.listConnections(missing, source=False, plugs=True, connections=True) or []
+            for j in range(0, len(connections), 2):
+                destinations.setdefault(connections[j], connections[j+1])
+
+        nodeTypes = dict()
+        if destinations:
+            showType = mc.ls(list(set(x.split('.')[0] for x in destinations.values())), showType=True) or []
+            nodeTypes = dict(zip(showType[::2], showType[1::2]))
+
+        nextFrontier = list()
+        for (i,n,a,t),source in zip(frontier, sources):
+            if source not in destinations:
+                continue
+            node, _, attr = destinations[source].partition('.')
+            nodeType = nodeTypes.get(node) or mc.nodeType(node)
             if nodeType.startswith('animCurveT') or nodeType.startswith('animBlendNode'):
-                return getChannelFromAnimCurve(source[0], plugs=plugs)
-            return source[0]
+                nextFrontier.append((i, node, attr, nodeType))
+            else:
+                result[i] = destinations[source] if plugs else node
+        frontier = nextFrontier
+
+    for i,c in enumerate(curves):
+        result[i] = result[first[c]]
+        _channelMemo[(c, plugs)] = result[i]
+    return result
 
 
 def getCurrentCamera():
@@ -535,6 +620,70 @@ def getIconPath():
                 return iconPath
 
 
+def getMatrixOffset(source, destination):
+    '''
+    Returns the offset matrix from the source to the destination at the current time, as a numpy array,
+    like the one a parentConstraint stores when maintaining offset.
+    '''
+    sourceMatrix = np.array(mc.getAttr(source+'.worldMatrix[0]')).reshape(4,4)
+    destinationMatrix = np.array(mc.getAttr(destination+'.worldMatrix[0]')).reshape(4,4)
+    return destinationMatrix.dot(np.linalg.inv(sourceMatrix))
+
+
+def getLocalTransforms(source, destination, times, offset=None):
+    '''
+    Returns the translate and rotate values the destination needs to match the source at each time,
+    as a dictionary of attribute name to array, in ui units. The source world matrix and destination
+    parent inverse matrix are sampled with a time argument and the math is done on all frames at once with numpy.
+    Rotate order, rotate axis and joint orient are taken into account, as are pivots on transforms.
+    '''
+
+    world = np.array([mc.getAttr(source+'.worldMatrix[0]', time=t) for t in times]).reshape(-1,4,4)
+    parentInverse = np.array([mc.getAttr(destination+'.parentInverseMatrix[0]', time=t) for t in times]).reshape(-1,4,4)
+
+    #maya matrices are row vector, so local = offset * world * parentInverse
+    if offset is not None:
+        world = np.matmul(offset, world)
+    local = np.matmul(world, parentInverse)
+
+    #take the scale out of the rotation rows
+    rotation = local[:,:3,:3]
+    rotation = rotation / np.linalg.norm(rotation, axis=2)[:,:,np.newaxis]
+
+    #matrices are in internal units, attributes are in ui units
+    toDistance = om2.MDistance.uiToInternal(1.0)
+    toAngle = om2.MAngle.uiToInternal(1.0)
+
+    #rotation = rotateAxis * rotate * jointOrient
+    rotateAxis = eulerToMatrix(np.array(mc.getAttr(destination+'.rotateAxis')[0])*toAngle)
+    rotation = np.matmul(rotateAxis.T, rotation)
+    isJoint = mc.nodeType(destination) == 'joint'
+    if isJoint:
+        jointOrient = eulerToMatrix(np.array(mc.getAttr(destination+'.jointOrient')[0])*toAngle)
+        rotation = np.matmul(rotation, jointOrient.T)
+
+    translation = local[:,3,:3]
+    if not isJoint:
+        #translate = local translation - ((scalePivotTranslate + scalePivot - scalePivot*scale - rotatePivot) * rotateAxis * rotate + rotatePivot + rotatePivotTranslate)
+        scale = np.array(mc.getAttr(destination+'.scale')[0])
+        scalePivot = np.array(mc.getAttr(destination+'.scalePivot')[0])*toDistance
+        scalePivotTranslate = np.array(mc.getAttr(destination+'.scalePivotTranslate')[0])*toDistance
+        rotatePivot = np.array(mc.getAttr(destination+'.rotatePivot')[0])*toDistance
+        rotatePivotTranslate = np.array(mc.getAttr(destination+'.rotatePivotTranslate')[0])*toDistance
+        pivot = scalePivotTranslate + scalePivot - scalePivot*scale - rotatePivot
+        translation = translation - np.einsum('j,njk->nk', pivot, np.matmul(rotateAxis, rotation)) - rotatePivot - rotatePivotTranslate
+
+    rotate = matrixToEuler(rotation, mc.getAttr(destination+'.rotateOrder'))
+
+    distance = om2.MDistance.internalToUI(1.0)
+    angle = om2.MAngle.internalToUI(1.0)
+    result = dict()
+    for i,axis in enumerate('XYZ'):
+        result['translate'+axis] = array('d', translation[:,i]*distance)
+        result['rotate'+axis] = array('d', rotate[:,i]*angle)
+    return result
+
+
 def getModelPanel():
     '''Return the active or first visible model panel.'''
     
@@ -655,6 +804,97 @@ def getSkinCluster(mesh):
     return None
 
 
+def harvestKeys(nodes, attributes, start, end, weights=True):
+    '''
+    Returns the keys on each node attribute between start and end, as a dictionary of (node, attribute) to
+    (times, inTangentTypes, outTangentTypes, inWeights, outWeights), with keys added at start and end if they aren't keyed.
+    Weights are None unless the curve is weighted and weights is True. Fixed tangents are returned as spline.
+    The key data for every curve is read into one KeyTable, so it's a handful of queries however many curves there are.
+    '''
+
+    #one query for every curve, then map each back to the node and attribute it drives.
+    #nodes are compared by handle, so it doesn't matter how their names are formatted.
+    def handle(node):
+        return om2.MObjectHandle(om2.MSelectionList().add(node).getDependNode(0)).hashCode()
+
+    wanted = dict()
+    for n in nodes:
+        h = handle(n)
+        for a in attributes:
+            wanted[(h,a)] = (n,a)
+
+    plugs = list()
+    curves = list()
+    allCurves = mc.keyframe(nodes, attribute=attributes, query=True, name=True) or []
+    for c,channel in zip(allCurves, getChannelsFromAnimCurves(allCurves)):
+        if not channel:
+            continue
+        node, _, attr = channel.partition('.')
+        plug = wanted.get((handle(node), attr))
+        if plug and plug not in plugs:
+            plugs.append(plug)
+            curves.append(c)
+    if not curves:
+        return dict()
+
+    #errors in maya 2016.5?
+    try:
+        table = KeyTable(curves, time=(start,end), tangents=True)
+    except RuntimeError:
+        table = KeyTable(curves, time=(start,end))
+
+    weighted = [False]*len(curves)
+    if weights and table.hasTangents:
+        weighted = mc.keyTangent(curves, query=True, weightedTangents=True)
+
+    spline = KeyTable.tangentTypeCode('spline')
+    auto = KeyTable.tangentTypeCode('auto')
+    #change fixed tangents to spline, because we can't set fixed tangents
+    names = list(KeyTable.tangentTypeNames)
+    if 'fixed' in names:
+        names[names.index('fixed')] = 'spline'
+
+    harvest = dict()
+    for i,plug in enumerate(plugs):
+        first = table.offsets[i]
+        last = table.offsets[i+1]
+        if first == last:
+            continue
+
+        times = table.times[first:last]
+        if table.hasTangents:
+            inTypes = table.inTangentTypes[first:last]
+            outTypes = table.outTangentTypes[first:last]
+        else:
+            inTypes = array('b', [auto])*(last-first)
+            outTypes = array('b', [auto])*(last-first)
+        inWeights = None
+        outWeights = None
+        if weighted[i]:
+            inWeights = table.inWeights[first:last]
+            outWeights = table.outWeights[first:last]
+
+        #add the start and end frames and tangents if they're not keyed
+        if times[0] != start:
+            times = array('d', [start]) + times
+            inTypes = array('b', [spline]) + inTypes
+            outTypes = array('b', [spline]) + outTypes
+            if weighted[i]:
+                inWeights = array('d', [1.0]) + inWeights
+                outWeights = array('d', [1.0]) + outWeights
+        if times[-1] != end:
+            times.append(end)
+            inTypes.append(spline)
+            outTypes.append(spline)
+            if weighted[i]:
+                inWeights.append(1.0)
+                outWeights.append(1.0)
+
+        harvest[plug] = (times, [names[x] for x in inTypes], [names[x] for x in outTypes], inWeights, outWeights)
+
+    return harvest
+
+
 def listAnimCurves(objOrAttrs):
     '''
     This lists connections to all types of animNodes
@@ -697,7 +937,12 @@ def longestCommonSubstring(data):
     return substr
 
 
-def matchBake(source=None, destination=None, bakeOnOnes=False, maintainOffset=False, preserveTangentWeight=True, translate=True, rotate=True, start=None, end=None):
+def matchBake(source=None, destination=None, bakeOnOnes=False, maintainOffset=False, preserveTangentWeight=True, translate=True, rotate=True, start=None, end=None, useMatrix=False):
+    '''
+    Bakes the destinations to match the sources, keeping the source key times and tangents unless baking on ones.
+    useMatrix computes the destination values from the source world matrix and destination parent inverse matrix,
+    instead of constraining temporary duplicates, so no nodes are created. This needs numpy.
+    '''
 
     if not source and not destination:
         sel = mc.ls(sl=True)
@@ -707,9 +952,6 @@ def matchBake(source=None, destination=None, bakeOnOnes=False, maintainOffset=Fa
         source = [sel[0]]
         destination = [sel[1]]
 
-    #save for reset:
-    resetTime = mc.currentTime(query=True)
-
     #frame range
     if start == None or end == None:
         start, end = frameRange()
@@ -724,147 +966,200 @@ def matchBake(source=None, destination=None, bakeOnOnes=False, maintainOffset=Fa
         OpenMaya.MGlobal.displayWarning('No attributes to bake!')
         return
 
+    if useMatrix and np is None:
+        OpenMaya.MGlobal.displayWarning('useMatrix needs numpy, baking with constraints instead.')
+        useMatrix = False
+
     duplicates = {}
-    keytimes = {}
+    offsets = {}
     constraint = list()
-    itt = {}
-    ott = {}
-    weighted = {}
-    itw = {}
-    otw = {}
-    #initialize allKeyTimes with start and end frames, since they may not be keyed
-    allKeyTimes = [start,end]
     for s,d in zip(source,destination):
 
-        #duplicate the destination
-        dup = mc.duplicate(d, name='temp#', parentOnly=True)[0]
-        for a in attributes:
-            mc.setAttr(dup+'.'+a, lock=False, keyable=True)
+        if useMatrix:
+            offsets[d] = getMatrixOffset(s, d) if maintainOffset else None
+        else:
+            #duplicate the destination
+            dup = mc.duplicate(d, name='temp#', parentOnly=True)[0]
+            for a in attributes:
+                mc.setAttr(dup+'.'+a, lock=False, keyable=True)
 
-        constraint.append(mc.parentConstraint(s, dup, maintainOffset=maintainOffset))
+            constraint.append(mc.parentConstraint(s, dup, maintainOffset=maintainOffset))
+            duplicates[d] = dup
 
         #cut keys on destination
         mc.cutKey(d, attribute=attributes, time=(start,end))
 
-        #set up our data dictionaries
-        duplicates[d] = dup
-        keytimes[d] = {}
-        itt[d] = {}
-        ott[d] = {}
-        weighted[d] = {}
-        itw[d] = {}
-        otw[d] = {}
-
-        #if we're baking on ones, we don't need keytimes
-        if not bakeOnOnes:
-            for a in attributes:
-                currKeytimes = mc.keyframe(s, attribute=a, time=(start,end), query=True, timeChange=True)
-                if not currKeytimes:
-                    continue
-
-                keytimes[d][a] = currKeytimes
-                allKeyTimes.extend(currKeytimes)
-
-                #errors in maya 2016.5?
-                try:
-                    itt[d][a] = mc.keyTangent(s, attribute=a, time=(start,end), query=True, inTangentType=True)
-                    ott[d][a] = mc.keyTangent(s, attribute=a, time=(start,end), query=True, outTangentType=True)
-                except RuntimeError as err:
-                    itt[d][a] = ['auto'] * len(currKeytimes)
-                    ott[d][a] = ['auto'] * len(currKeytimes)
-
-                if preserveTangentWeight and mc.keyTangent(s, attribute=a, query=True, weightedTangents=True)[0]:
-                    weighted[d][a] = True
-                    itw[d][a] = mc.keyTangent(s, attribute=a, time=(start,end), query=True, inWeight=True)
-                    otw[d][a] = mc.keyTangent(s, attribute=a, time=(start,end), query=True, outWeight=True)
-
-                #change fixed tangents to spline, because we can't set fixed tangents
-                for i, each in enumerate(itt[d][a]):
-                    if each == 'fixed':
-                        itt[d][a][i] = 'spline'
-
-                for i, each in enumerate(ott[d][a]):
-                    if each == 'fixed':
-                        ott[d][a][i] = 'spline'
-
-                #add the start and end frames and tangents if they're not keyed
-                if not start in keytimes[d][a]:
-                    keytimes[d][a].insert(0,start)
-                    itt[d][a].insert(0,'spline')
-                    ott[d][a].insert(0,'spline')
-                    if a in weighted[d]:
-                        itw[d][a].insert(0, 1.0)
-                        otw[d][a].insert(0, 1.0)
-                if not end in keytimes[d][a]:
-                    keytimes[d][a].append(end)
-                    itt[d][a].append('spline')
-                    ott[d][a].append('spline')
-                    if a in weighted[d]:
-                        itw[d][a].append(1.0)
-                        otw[d][a].append(1.0)
-
-                #reverse these, because we want to pop but start from the beginning
-                itt[d][a].reverse()
-                ott[d][a].reverse()
-                if a in weighted[d]:
-                    itw[d][a].reverse()
-                    otw[d][a].reverse()
-
-
+    #if we're baking on ones, we don't need keytimes
     if bakeOnOnes:
         allKeyTimes = range(int(start), int(end)+1)
+        harvest = dict()
     else:
-        allKeyTimes = list(set(allKeyTimes))
-        allKeyTimes.sort()
+        harvest = harvestKeys(source, attributes, start, end, weights=preserveTangentWeight)
+
+    #values are read with a time argument, which evaluates the constraint in a DG context at that time,
+    #so the current time never moves and the rest of the scene isn't evaluated.
+    #every attribute is sampled at every time any of them needs, so rotations can be filtered together.
+    sampled = dict()
+    for s,d in zip(source, destination):
+        if bakeOnOnes:
+            sampleTimes = allKeyTimes
+        else:
+            sampleTimes = sorted(set(t for a in attributes if (s,a) in harvest for t in harvest[(s,a)][0]))
+        if not sampleTimes:
+            continue
+        if useMatrix:
+            local = getLocalTransforms(s, d, sampleTimes, offset=offsets[d])
+        else:
+            local = dict((a, array('d', [mc.getAttr(duplicates[d]+'.'+a, time=t) for t in sampleTimes])) for a in attributes)
+        sampled[d] = (sampleTimes, local)
+
+    if rotate and np is not None:
+        #remove euler flips from all the destinations in one pass, grouped by number of frames
+        toRadians = om2.MAngle.uiToInternal(1.0)
+        sources = dict(zip(destination, source))
+        groups = dict()
+        for d in sampled:
+            groups.setdefault(len(sampled[d][0]), list()).append(d)
+        for group in groups.values():
+            rotations = np.array([[sampled[d][1]['rotate'+x] for x in 'XYZ'] for d in group]).transpose(0,2,1)*toRadians
+            #each rotate curve only gets keys at its own source key times, so only flip where all three are keyed
+            flippable = list()
+            for d in group:
+                keyedAll = set(sampled[d][0])
+                if not bakeOnOnes:
+                    for x in 'XYZ':
+                        keyedAll.intersection_update(harvest.get((sources[d],'rotate'+x), ((),))[0])
+                flippable.append([t in keyedAll for t in sampled[d][0]])
+            rotations = eulerFilter(rotations, [mc.getAttr(d+'.rotateOrder') for d in group], flippable)/toRadians
+            for d,r in zip(group, rotations):
+                for i,x in enumerate('XYZ'):
+                    sampled[d][1]['rotate'+x] = array('d', r[:,i])
+
+    #everything is sampled first, then each destination curve is written in one go.
+    samples = list()
+    for s,d in zip(source, destination):
+        if d not in sampled:
+            continue
+        sampleTimes, local = sampled[d]
+        index = dict((t,i) for i,t in enumerate(sampleTimes))
+        for a in attributes:
+            if bakeOnOnes:
+                times = allKeyTimes
+                inTangents = ['spline']*len(times)
+                outTangents = inTangents
+                inWeights = outWeights = None
+            elif (s,a) in harvest:
+                #tangent types and weights line up with keytimes
+                times, inTangents, outTangents, inWeights, outWeights = harvest[(s,a)]
+            else:
+                continue
+            values = array('d', [local[a][index[frame]] for frame in times])
+            samples.append((d, a, times, values, inTangents, outTangents, inWeights, outWeights))
 
     with UndoChunk():
-        #if 
-        with IsolateViews():
-            for frame in allKeyTimes:
-                #cycle through all the frames
-                mc.currentTime(frame, edit=True)
-                for d in destination:
-                    weightedSet = False
-                    for a in attributes:
-                        try:
-                            v = mc.getAttr(duplicates[d]+'.'+a)
-                            if bakeOnOnes:
-                                mc.setKeyframe(d, attribute=a, time=frame,
-                                               value=v,
-                                               itt='spline',
-                                               ott='spline')
-                                mc.setAttr(d+'.'+a, v)
-                            elif a in keytimes[d] and frame in keytimes[d][a]:
-                                #tangent types line up with keytimes
-                                mc.setKeyframe(d, attribute=a, time=frame,
-                                               value=v,
-                                               itt=itt[d][a].pop(),
-                                               ott=ott[d][a].pop()
-                                               )
-                                mc.setAttr(d+'.'+a, v)
-
-                        except:
-                            pass
-
-            #this was breaking the tangents inside the other loop, so run it after.
-            if not bakeOnOnes and preserveTangentWeight:
-                for d in destination:
-                    for a in attributes:
-                        if a in weighted[d]:
-                            mc.keyTangent(d, attribute=a, edit=True, weightedTangents=True)
-                            for frame in keytimes[d][a]:
-                                mc.keyTangent(d, attribute=a, time=(frame,), edit=True, absolute=True, inWeight=itw[d][a].pop(), outWeight=otw[d][a].pop())
-
-        #reset time and selection
-        mc.currentTime(resetTime, edit=True)
+        for sample in samples:
+            try:
+                setAnimCurveKeys(*sample)
+            except RuntimeError as err:
+                OpenMaya.MGlobal.displayWarning('Could not bake '+sample[0]+'.'+sample[1]+': '+str(err))
+
+        #reset selection
         mc.select(destination, replace=True)
 
-    mc.delete(duplicates.values())
-    if rotate:
-        mc.filterCurve(mc.listConnections(destination,type='animCurve'))
+    if duplicates:
+        mc.delete(duplicates.values())
+    if rotate and np is None:
+        rotateCurves = mc.keyframe(destination, attribute=('rotateX','rotateY','rotateZ'), query=True, name=True)
+        if rotateCurves:
+            mc.filterCurve(rotateCurves)
     if bakeOnOnes:
         mc.keyTangent(destination, attribute=attributes, itt='spline', ott='spline')
 
+#axis order for each rotateOrder value
+ROTATE_ORDERS = ((0,1,2), (1,2,0), (2,0,1), (0,2,1), (1,0,2), (2,1,0))
+
+def eulerToMatrix(rotation, rotateOrder=0):
+    '''
+    Returns the row vector rotation matrix for euler angles in radians. Rotation can be a single
+    xyz triplet, or an array of them, in which case an array of matrices is returned.
+    '''
+    rotation = np.asarray(rotation, dtype=float)
+    single = rotation.ndim == 1
+    rotation = rotation.reshape(-1,3)
+    matrix = np.tile(np.identity(3), (len(rotation),1,1))
+    for axis in ROTATE_ORDERS[rotateOrder]:
+        a = (axis+1)%3
+        b = (axis+2)%3
+        cos = np.cos(rotation[:,axis])
+        sin = np.sin(rotation[:,axis])
+        axisMatrix = np.tile(np.identity(3), (len(rotation),1,1))
+        axisMatrix[:,a,a] = cos
+        axisMatrix[:,a,b] = sin
+        axisMatrix[:,b,a] = -sin
+        axisMatrix[:,b,b] = cos
+        #rotations are applied in order, so each axis is multiplied on the right
+        matrix = np.matmul(matrix, axisMatrix)
+    if single:
+        return matrix[0]
+    return matrix
+
+
+def eulerFilter(rotations, rotateOrders=0, flippable=None):
+    '''
+    Returns euler rotations in radians with the flips taken out, so each frame is as close as possible to the one before.
+    Rotations is an array of frames of xyz, or an array of those to filter many at once, with a rotate order for each.
+    Every frame is checked against the equivalent rotation that flips the first and last axes and mirrors the middle one,
+    and each axis is moved by whole turns to be closest to the previous frame.
+    Flippable is an optional array of booleans for each frame, and frames where it's False only get whole turns,
+    which is for frames where not every axis is keyed, since flipping changes all three.
+    '''
+
+    rotations = np.array(rotations, dtype=float)
+    single = rotations.ndim == 2
+    if single:
+        rotations = rotations[np.newaxis]
+    if flippable is None:
+        flippable = np.ones(rotations.shape[:2], dtype=bool)
+    else:
+        flippable = np.array(flippable, dtype=bool).reshape(rotations.shape[:2])
+
+    #mark the middle axis of each rotate order
+    middle = np.zeros((len(rotations),3), dtype=bool)
+    for i,order in enumerate(np.broadcast_to(rotateOrders, (len(rotations),))):
+        middle[i, ROTATE_ORDERS[order][1]] = True
+
+    turn = 2*np.pi
+    for f in range(1, rotations.shape[1]):
+        previous = rotations[:,f-1]
+        current = rotations[:,f]
+        alternate = np.where(middle, np.pi-current, current+np.pi)
+        current = current + turn*np.round((previous-current)/turn)
+        alternate = alternate + turn*np.round((previous-alternate)/turn)
+        useAlternate = np.abs(alternate-previous).sum(axis=1) < np.abs(current-previous).sum(axis=1)
+        useAlternate &= flippable[:,f]
+        rotations[:,f] = np.where(useAlternate[:,np.newaxis], alternate, current)
+
+    if single:
+        return rotations[0]
+    return rotations
+
+
+def matrixToEuler(matrices, rotateOrder=0):
+    '''
+    Returns euler angles in radians, as an array of xyz triplets, for an array of row vector rotation matrices.
+    '''
+    i, j, k = ROTATE_ORDERS[rotateOrder]
+    #odd permutations of xyz flip the signs
+    sign = 1.0 if (i,j,k) in ((0,1,2), (1,2,0), (2,0,1)) else -1.0
+    #transpose to column vector, where the matrix is Rk * Rj * Ri
+    m = np.transpose(matrices, (0,2,1))
+    result = np.zeros((len(m),3))
+    result[:,j] = np.arcsin(np.clip(-sign*m[:,k,i], -1.0, 1.0))
+    result[:,i] = np.arctan2(sign*m[:,k,j], m[:,k,k])
+    result[:,k] = np.arctan2(sign*m[:,j,i], m[:,i,i])
+    return result
+
+
 def message(msg, position='midCenterTop'):
     
     OpenMaya.MGlobal.displayWarning(msg)
@@ -872,27 +1167,82 @@ def message(msg, position='midCenterTop'):
     mc.inViewMessage( amg=msg, pos=position, fade=True, fadeStayTime=fadeTime, dragKill=True)
 
 
-def minimizeRotationCurves(obj):
+def minimizeRotationCurves(objs):
     '''
     Sets rotation animation to the value closest to zero.
+    Takes an object or a list of objects, which are filtered together, and only edits keys that change.
     '''
 
-    rotateCurves = mc.keyframe(obj, attribute=('rotateX','rotateY', 'rotateZ'), query=True, name=True)
+    if isinstance(objs, basestring):
+        objs = [objs]
 
-    if not rotateCurves or len(rotateCurves) < 3:
-        return
+    if np is None:
+        for obj in objs:
+            rotateCurves = mc.keyframe(obj, attribute=('rotateX','rotateY', 'rotateZ'), query=True, name=True)
+
+            if not rotateCurves or len(rotateCurves) < 3:
+                continue
 
-    keyTimes = mc.keyframe(rotateCurves, query=True, timeChange=True)
-    tempFrame = sorted(keyTimes)[0] - 1
+            keyTimes = mc.keyframe(rotateCurves, query=True, timeChange=True)
+            tempFrame = sorted(keyTimes)[0] - 1
 
-    #set a temp frame
-    mc.setKeyframe(rotateCurves, time=(tempFrame,), value=0)
+            #set a temp frame
+            mc.setKeyframe(rotateCurves, time=(tempFrame,), value=0)
+
+            #euler filter
+            mc.filterCurve(rotateCurves)
+
+            #delete temp key
+            mc.cutKey(rotateCurves, time=(tempFrame,))
+        return
 
-    #euler filter
-    mc.filterCurve(rotateCurves)
+    #evaluate each object's three rotate curves at all of their key times, through the API so it's all in memory
+    data = list()
+    for obj in objs:
+        rotateCurves = mc.keyframe(obj, attribute=('rotateX','rotateY', 'rotateZ'), query=True, name=True)
+        if not rotateCurves or len(rotateCurves) < 3:
+            continue
+        channels = getChannelsFromAnimCurves(rotateCurves)
+        curves = [None]*3
+        for c,channel in zip(rotateCurves, channels):
+            if channel and channel[-7:-1] == 'rotate':
+                curves['XYZ'.index(channel[-1])] = c
+        if None in curves:
+            continue
 
-    #delete temp key
-    mc.cutKey(rotateCurves, time=(tempFrame,))
+        selection = om2.MSelectionList()
+        for c in curves:
+            selection.add(c)
+        fns = [oma2.MFnAnimCurve(selection.getDependNode(i)) for i in range(3)]
+        unit = om2.MTime.uiUnit()
+        keyTimes = [[fn.input(i).asUnits(unit) for i in range(fn.numKeys)] for fn in fns]
+        times = sorted(set(t for each in keyTimes for t in each))
+        rotations = np.array([[fn.evaluate(om2.MTime(t, unit)) for fn in fns] for t in times])
+        #start from zero, like keying a temp frame before the first key
+        rotations = np.concatenate([np.zeros((1,3)), rotations])
+        #only flip where all three axes have a key, elsewhere an axis only moves by whole turns
+        keyedAll = set(keyTimes[0]).intersection(keyTimes[1], keyTimes[2])
+        flippable = [True]+[t in keyedAll for t in times]
+        data.append((curves, fns, keyTimes, times, rotations, flippable, mc.getAttr(obj+'.rotateOrder')))
+
+    #filter everything with the same number of frames together
+    groups = dict()
+    for each in data:
+        groups.setdefault(len(each[3]), list()).append(each)
+    for group in groups.values():
+        filtered = eulerFilter([each[4] for each in group], [each[6] for each in group], [each[5] for each in group])
+        for (curves, fns, keyTimes, times, rotations, flippable, rotateOrder), result in zip(group, filtered):
+            index = dict((t,i+1) for i,t in enumerate(times))
+            toUI = om2.MAngle.internalToUI(1.0)
+            for axis,(c,fn,curveTimes) in enumerate(zip(curves, fns, keyTimes)):
+                #the change in ui units for each key, and edit runs of keys that change by the same amount
+                changes = [round((result[index[t],axis]-rotations[index[t],axis])*toUI, 6) for t in curveTimes]
+                runStart = 0
+                for i in range(1, len(changes)+1):
+                    if i == len(changes) or changes[i] != changes[runStart]:
+                        if changes[runStart]:
+                            mc.keyframe(c, edit=True, relative=True, index=(runStart, i-1), valueChange=changes[runStart])
+                        runStart = i
 
 
 def renderShelfIcon(name='tmp', width=32, height=32):
@@ -939,6 +1289,54 @@ def renderShelfIcon(name='tmp', width=32, height=32):
     return image
 
 
+def setAnimCurveKeys(node, attribute, times, values, inTangentTypes=None, outTangentTypes=None, inWeights=None, outWeights=None):
+    '''
+    Keys an attribute with many keys at once, replacing any keys in the time range.
+    The keys are written straight onto the attribute's curve with a few commands, all undoable:
+    one setKeyframe for all the times, one setAttr for all the values, and one keyTangent for each
+    tangent type and weight that's used. Values are in ui units. If weights are passed in, the tangents are weighted.
+    '''
+
+    if not len(times):
+        return
+
+    plug = node+'.'+attribute
+    if mc.keyframe(plug, query=True, name=True):
+        mc.cutKey(plug, time=(times[0], times[-1]), clear=True)
+
+    #create the keys, which also creates the curve if there isn't one
+    mc.setKeyframe(plug, time=list(times), value=values[0])
+    curve = mc.keyframe(plug, query=True, name=True)[0]
+
+    #the range was cleared, so the new keys are a block of indices, in the same order as the times
+    indices = mc.keyframe(curve, query=True, time=(times[0], times[-1]), indexValue=True) or []
+    if len(indices) != len(times):
+        raise RuntimeError('Keys on '+plug+' did not line up with the times being set.')
+    keyTimeValue = list()
+    for t,v in zip(times, values):
+        keyTimeValue.extend((t,v))
+    mc.setAttr(curve+'.keyTimeValue['+str(indices[0])+':'+str(indices[-1])+']', *keyTimeValue)
+
+    #group keys that share a setting, so each one is a single command
+    def groupTimes(settings):
+        groups = dict()
+        for t,x in zip(times, settings):
+            groups.setdefault(x, list()).append((t,t))
+        return groups.items()
+
+    if inTangentTypes:
+        for itt,keyTimes in groupTimes(inTangentTypes):
+            mc.keyTangent(curve, edit=True, time=keyTimes, inTangentType=itt)
+    if outTangentTypes:
+        for ott,keyTimes in groupTimes(outTangentTypes):
+            mc.keyTangent(curve, edit=True, time=keyTimes, outTangentType=ott)
+
+    if inWeights is not None and outWeights is not None:
+        mc.keyTangent(curve, edit=True, weightedTangents=True)
+        for (inWeight,outWeight),keyTimes in groupTimes(zip(inWeights, outWeights)):
+            mc.keyTangent(curve, edit=True, absolute=True, time=keyTimes, inWeight=inWeight, outWeight=outWeight)
+
+
 def setAnimValue(plug, value, tangentType=None):
     '''
     Sets key if the channel is keyed, otherwise setAttr
@@ -1138,6 +1536,71 @@ class IsolateViews():
                 mc.isolateSelect(each, state=state)
 
 
+class KeyIndex(object):
+    '''
+    Sorted key times, fetched with a single keyframe query.
+    Arguments are passed on to the keyframe command, so this can index the selection,
+    a list of curves or nodes, or a single attribute. Range, key-at-frame and
+    next/previous lookups are answered with bisect instead of querying maya.
+    '''
+
+    def __init__(self, *args, **kwargs):
+
+        keyTimes = mc.keyframe(*args, query=True, timeChange=True, **kwargs)
+        self.times = sorted(set(keyTimes)) if keyTimes else list()
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def __iter__(self):
+        return iter(self.times)
+
+
+    def inRange(self, start, end):
+        '''
+        Returns key times from start up to, but not including, end. Sub-frame keys are included.
+        '''
+        return self.times[bisect.bisect_left(self.times, start):bisect.bisect_left(self.times, end)]
+
+
+    def keyAt(self, time, tolerance=0.0):
+        '''
+        Returns True if there's a key within tolerance of the time.
+        '''
+        i = bisect.bisect_left(self.times, time-tolerance)
+        return i < len(self.times) and self.times[i] <= time+tolerance
+
+
+    def nextKey(self, time):
+        '''
+        Returns the first key after the time, or None.
+        '''
+        i = bisect.bisect_right(self.times, time)
+        if i < len(self.times):
+            return self.times[i]
+
+
+    def previousKey(self, time):
+        '''
+        Returns the last key before the time, or None.
+        '''
+        i = bisect.bisect_left(self.times, time)
+        if i:
+            return self.times[i-1]
+
+
+    def firstKey(self):
+        if self.times:
+            return self.times[0]
+
+
+    def lastKey(self):
+        if self.times:
+            return self.times[-1]
+
+
 class KeySelection(object):
     '''
 
@@ -1173,6 +1636,10 @@ class KeySelection(object):
         #other housekeeping
         self._curvesCulled = False
 
+        #sorted key times, reset by any method that edits keys
+        self._keyTimes = None
+        self._keyTimesState = None
+
 
     @property
     def curves(self):
@@ -1199,18 +1666,25 @@ class KeySelection(object):
         # need to remove curves which are unkeyable
         # supposedly referenced keys are keyable in 2013, I'll need to test that and update
         if self._curves and not self._curvesCulled:
-            remove = list()
-            for c in self._curves:
-                if mc.referenceQuery(c, isNodeReferenced=True):
-                    remove.append(c)
-                else:
-                    plug = mc.listConnections('.'.join((c,'output')), source=False, plugs=True)
-                    if plug:
-                        if not mc.getAttr(plug, keyable=True) and not mc.getAttr(plug, settable=True):
-                            remove.append(c)
+            remove = set(mc.ls(self._curves, referencedNodes=True) or [])
+            curves = [c for c in self._curves if c not in remove]
+            if curves:
+                # pairs of curve output, destination plug, for all curves at once
+                connections = mc.listConnections([c+'.output' for c in curves], source=False, plugs=True, connections=True) or []
+                plugs = dict()
+                for i in range(0, len(connections), 2):
+                    curve = connections[i].rsplit('.',1)[0]
+                    if curve not in plugs:
+                        plugs[curve] = connections[i+1]
+                # only query each destination attribute once
+                locked = dict()
+                for curve, plug in plugs.items():
+                    if plug not in locked:
+                        locked[plug] = not mc.getAttr(plug, keyable=True) and not mc.getAttr(plug, settable=True)
+                    if locked[plug]:
+                        remove.add(curve)
             if remove:
-                for r in remove:
-                    self._curves.remove(r)
+                self._curves = [c for c in self._curves if c not in remove]
             self._curvesCulled = True
 
         return self._curves
@@ -1225,8 +1699,8 @@ class KeySelection(object):
         if not self._channels:
 
             if self._curves:
-                for c in self._curves:
-                    self._channels.append(getChannelFromAnimCurve(c))
+                #curves that aren't connected to a channel are skipped
+                self._channels = [x for x in getChannelsFromAnimCurves(self._curves) if x]
             elif self._nodes:
                 for obj in self._nodes:
                     keyable = mc.listAttr(obj, keyable=True, unlocked=True, hasData=True, settable=True)
@@ -1246,9 +1720,8 @@ class KeySelection(object):
 
             if self._curves:
                 self._nodes = list()
-                for c in self._curves:
-                    n = getChannelFromAnimCurve(c, plugs=False)
-                    if not n in self._nodes:
+                for n in getChannelsFromAnimCurves(self._curves, plugs=False):
+                    if n and not n in self._nodes:
                         self._nodes.append(n)
             elif self._channels:
                 for each in self._channels:
@@ -1302,24 +1775,20 @@ class KeySelection(object):
         '''
         This returns an expanded list of times, which is synced with the curve list.
         '''
-        timeList = list()
-        theTime = self.time
-        for c in self.curves:
-            curveTime = tuple(mc.keyframe(c, time=(theTime,), query=True, timeChange=True))
-            if len(curveTime) == 1:
-                curveTime = (curveTime[0],)
-            timeList.append(curveTime)
-        return timeList
+        table = self.keyTable()
+        return table.split(table.times)
 
     @property
     def values(self):
-        valueList = list()
-        for c in self.curves:
-            curveValues = mc.keyframe(c, query=True, valueChange=True)
-            if len(curveValues) == 1:
-                curveValues = (curveValues[0],)
-            valueList.append(curveValues)
-        return valueList
+        table = self.keyTable(useTime=False)
+        return table.split(table.values)
+
+
+    def keyTable(self, useTime=True, tangents=False):
+        '''
+        Returns a KeyTable snapshot of the keys on this selection's curves, for tools that need to walk a lot of keys.
+        '''
+        return KeyTable(self.curves, self.time if useTime else None, tangents=tangents)
 
 
     @property
@@ -1638,6 +2107,7 @@ class KeySelection(object):
         self._channels = list()
         self._nodes = list()
         self._time = kwargs['time']
+        self._keyTimes = None
 
         if deleteSubFrames:
             #remove nearby sub-frames
@@ -1655,6 +2125,9 @@ class KeySelection(object):
         Wrapper for the keyframe command. Curve and time arguments will be provided based on
         how this object was intitialized, otherwise usage is the same as maya's keyframe command.
         '''
+        if kwargs.get('edit') or kwargs.get('e'):
+            self._keyTimes = None
+
         if self.selected:
             #it's important that selection test first, becuase it's called by the time property
             kwargs['sl'] = True
@@ -1671,6 +2144,8 @@ class KeySelection(object):
         Option to delete sub-frames.
         '''
 
+        self._keyTimes = None
+
         if not 'includeUpperBound' in kwargs:
             kwargs['includeUpperBound'] = False
 
@@ -1708,6 +2183,7 @@ class KeySelection(object):
         '''
 
         '''
+        self._keyTimes = None
         mc.pasteKey(self.args, option=option, **kwargs)
 
 
@@ -1743,6 +2219,7 @@ class KeySelection(object):
         if timePivot == 'current':
             timePivot = self.currentTime
 
+        self._keyTimes = None
         mc.scaleKey(self.curves, timePivot=timePivot, **kwargs)
 
 
@@ -1788,18 +2265,13 @@ class KeySelection(object):
         if roundFrame:
             tolerence = 0.5
 
+        #keys are sorted, so bisect instead of scanning. if there isn't one, wrap around to the other end.
         if which == 'previous':
-            findTime = keyTimes[-1]
-            for x in reversed(keyTimes):
-                if self.currentTime - x > tolerence:
-                    findTime=x
-                    break
+            i = bisect.bisect_left(keyTimes, self.currentTime-tolerence)
+            findTime = keyTimes[i-1] if i else keyTimes[-1]
         elif which == 'next':
-            findTime = keyTimes[0]
-            for x in keyTimes:
-                if x - self.currentTime > tolerence:
-                    findTime=x
-                    break
+            i = bisect.bisect_right(keyTimes, self.currentTime+tolerence)
+            findTime = keyTimes[i] if i < len(keyTimes) else keyTimes[0]
         elif which == 'first':
             findTime = keyTimes[0]
         elif which == 'last':
@@ -1815,12 +2287,262 @@ class KeySelection(object):
     def getSortedKeyTimes(self):
         '''
         Returns a list of the key times in order without duplicates.
+        This is cached until keys are edited through this keySelection, or its curves or time change.
         '''
 
-        keyTimes = self.keyframe(query=True, timeChange=True)
-        if not keyTimes:
+        time = tuple(self._time) if isinstance(self._time, list) else self._time
+        state = (time, self._timeRangeStart, self._timeRangeEnd, self.selected,
+                 tuple(self._nodes or ()), tuple(self._channels or ()))
+
+        if self._keyTimes is None or state != self._keyTimesState:
+            keyTimes = self.keyframe(query=True, timeChange=True)
+            self._keyTimes = sorted(set(keyTimes)) if keyTimes else list()
+            self._keyTimesState = state
+
+        if not self._keyTimes:
             return
-        return sorted(list(set(keyTimes)))
+        return self._keyTimes
+
+
+
+class KeyTable(object):
+    '''
+    A snapshot of the keys on a list of curves, fetched with as few queries as possible
+    and stored as flat columns. The keys for curves[i] are offsets[i]:offsets[i+1] in each column,
+    and curveIds holds the curve index of each key. Tangent types are stored as codes into tangentTypeNames.
+    Tangent columns are only filled if the table is created with tangents=True.
+    Filtering, slicing and diffing don't go back to maya.
+    '''
+
+    tangentTypeNames = list()
+    _tangentTypeCodes = dict()
+
+    keyColumns = ('times', 'values', 'inTangentTypes', 'outTangentTypes', 'inWeights', 'outWeights')
+
+    def __init__(self, curves, time=None, tangents=False):
+
+        self.curves = list(curves or [])
+        self.offsets = array('l', [0])
+        self.curveIds = array('i')
+        self.times = array('d')
+        self.values = array('d')
+        self.inTangentTypes = array('b')
+        self.outTangentTypes = array('b')
+        self.inWeights = array('d')
+        self.outWeights = array('d')
+
+        if not self.curves:
+            return
+
+        #times and values come back interleaved, and index values start over at 0 for each curve
+        data = mc.keyframe(self.curves, query=True, timeChange=True, valueChange=True) or []
+        starts = [i for i,x in enumerate(mc.keyframe(self.curves, query=True, indexValue=True) or []) if x == 0]
+        if tangents:
+            tangentTypes = mc.keyTangent(self.curves, query=True, inTangentType=True, outTangentType=True) or []
+            weights = mc.keyTangent(self.curves, query=True, inWeight=True, outWeight=True) or []
+        if len(starts) != len(self.curves):
+            #there's a curve without keys, so the flat result can't be split, query them one at a time
+            data = list()
+            starts = list()
+            tangentTypes = list()
+            weights = list()
+            for c in self.curves:
+                starts.append(len(data)//2)
+                data.extend(mc.keyframe(c, query=True, timeChange=True, valueChange=True) or [])
+                if tangents:
+                    tangentTypes.extend(mc.keyTangent(c, query=True, inTangentType=True, outTangentType=True) or [])
+                    weights.extend(mc.keyTangent(c, query=True, inWeight=True, outWeight=True) or [])
+        starts.append(len(data)//2)
+
+        inTime = self.timeTest(time)
+        for i in range(len(self.curves)):
+            for k in range(starts[i], starts[i+1]):
+                if inTime(data[k*2]):
+                    self.curveIds.append(i)
+                    self.times.append(data[k*2])
+                    self.values.append(data[k*2+1])
+                    if tangents:
+                        self.inTangentTypes.append(self.tangentTypeCode(tangentTypes[k*2]))
+                        self.outTangentTypes.append(self.tangentTypeCode(tangentTypes[k*2+1]))
+                        self.inWeights.append(weights[k*2])
+                        self.outWeights.append(weights[k*2+1])
+            self.offsets.append(len(self.times))
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    @classmethod
+    def tangentTypeCode(cls, name):
+        '''
+        Returns the code for a tangent type name, so each name is only stored once.
+        '''
+        if name not in cls._tangentTypeCodes:
+            cls._tangentTypeCodes[name] = len(cls.tangentTypeNames)
+            cls.tangentTypeNames.append(name)
+        return cls._tangentTypeCodes[name]
+
+
+    @property
+    def hasTangents(self):
+        return len(self.inTangentTypes) == len(self.times)
+
+
+    def curveKeys(self, curve):
+        '''
+        Returns the range of key indices for a curve name or index.
+        '''
+        if not isinstance(curve, int):
+            curve = self.curves.index(curve)
+        return range(self.offsets[curve], self.offsets[curve+1])
+
+
+    def row(self, index):
+        '''
+        Returns a dictionary of one key's data, with tangent type names instead of codes.
+        '''
+        row = {'curve':self.curves[self.curveIds[index]], 'time':self.times[index], 'value':self.values[index]}
+        if self.hasTangents:
+            row['inTangentType'] = self.tangentTypeNames[self.inTangentTypes[index]]
+            row['outTangentType'] = self.tangentTypeNames[self.outTangentTypes[index]]
+            row['inWeight'] = self.inWeights[index]
+            row['outWeight'] = self.outWeights[index]
+        return row
+
+
+    def subset(self, indices):
+        '''
+        Returns a new table with only the keys at the given indices, which should be in order.
+        The curve list stays the same, curves without any keys left just have an empty range.
+        '''
+
+        table = KeyTable(None)
+        table.curves = list(self.curves)
+        columns = [x for x in self.keyColumns if len(getattr(self, x)) == len(self.times)]
+        for i in indices:
+            table.curveIds.append(self.curveIds[i])
+            for column in columns:
+                getattr(table, column).append(getattr(self, column)[i])
+
+        #rebuild the offsets from the curve ids
+        counts = [0]*len(self.curves)
+        for c in table.curveIds:
+            counts[c] += 1
+        for count in counts:
+            table.offsets.append(table.offsets[-1]+count)
+        return table
+
+
+    def filter(self, test=None, curves=None, time=None):
+        '''
+        Returns a new table with the keys that pass a test function, which is passed the key index,
+        are on one of the given curves, and are in a maya style time argument.
+        '''
+
+        keep = range(len(self.times))
+        if curves is not None:
+            curves = set(curves)
+            keep = [i for i in keep if self.curves[self.curveIds[i]] in curves]
+        if time is not None:
+            inTime = self.timeTest(time)
+            keep = [i for i in keep if inTime(self.times[i])]
+        if test:
+            keep = [i for i in keep if test(i)]
+        return self.subset(keep)
+
+
+    def slice(self, start=None, end=None):
+        '''
+        Returns a new table with the keys from start to end, inclusive. Either end can be left open.
+        '''
+        startTime = '' if start is None else str(start)
+        endTime = '' if end is None else str(end)
+        return self.filter(time=startTime+':'+endTime)
+
+
+    def diff(self, other, tolerance=0.0001):
+        '''
+        Compares this table with another, for example a snapshot taken before an edit.
+        Returns lists of (curve, time) for keys that were added, removed, or changed in value, tangents or weights.
+        '''
+
+        def keys(table):
+            rows = dict()
+            for i in range(len(table.times)):
+                rows[(table.curves[table.curveIds[i]], round(table.times[i]/tolerance))] = i
+            return rows
+
+        mine = keys(self)
+        theirs = keys(other)
+
+        tangents = self.hasTangents and other.hasTangents
+        added = list()
+        changed = list()
+        for key,i in mine.items():
+            if key not in theirs:
+                added.append((key[0], self.times[i]))
+                continue
+            j = theirs[key]
+            if abs(self.values[i]-other.values[j]) > tolerance:
+                changed.append((key[0], self.times[i]))
+            elif tangents and (self.inTangentTypes[i] != other.inTangentTypes[j]
+                               or self.outTangentTypes[i] != other.outTangentTypes[j]
+                               or abs(self.inWeights[i]-other.inWeights[j]) > tolerance
+                               or abs(self.outWeights[i]-other.outWeights[j]) > tolerance):
+                changed.append((key[0], self.times[i]))
+        removed = [(key[0], other.times[j]) for key,j in theirs.items() if key not in mine]
+
+        return sorted(added), sorted(removed), sorted(changed)
+
+
+    @staticmethod
+    def timeTest(time, tolerance=0.0001):
+        '''
+        Returns a function which tells if a time is included by a maya keyframe time argument,
+        so the table can be filtered without querying maya again.
+        '''
+
+        if time is None:
+            return lambda t: True
+
+        if isinstance(time, list):
+            tests = [KeyTable.timeTest(x, tolerance) for x in time]
+            return lambda t: any(test(t) for test in tests)
+
+        if isinstance(time, basestring):
+            start, sep, end = time.partition(':')
+            if not sep:
+                return KeyTable.timeTest(float(start), tolerance)
+            start = float(start) if start else None
+            end = float(end) if end else None
+            return lambda t: (start is None or t >= start-tolerance) and (end is None or t <= end+tolerance)
+
+        if isinstance(time, tuple):
+            if len(time) == 1:
+                return KeyTable.timeTest(time[0], tolerance)
+            if len(time) == 2 and not isinstance(time[0], (tuple, basestring)):
+                start, end = time
+                return lambda t: start-tolerance <= t <= end+tolerance
+            return KeyTable.timeTest(list(time), tolerance)
+
+        return lambda t: abs(t-time) <= tolerance
+
+
+    def split(self, column):
+        '''
+        Returns a column as a list of tuples, one per curve.
+        '''
+        return [tuple(column[self.offsets[i]:self.offsets[i+1]]) for i in range(len(self.curves))]
+
+
+    def asArray(self, column):
+        '''
+        Returns a column as a numpy array sharing the same memory, or the column itself if numpy isn't available.
+        '''
+        if np is None or not len(column):
+            return column
+        return np.frombuffer(column, dtype=column.typecode)
 
 
 
@@ -2211,6 +2933,48 @@ class SkipUndo():
         mc.undoInfo(stateWithoutFlush=True)
 
 
+class Transaction():
+    '''
+    Wraps a whole operation in one undo chunk, and suspends refresh and turns off autokey
+    once for the duration instead of around every edit. Nested transactions are absorbed
+    by the outermost one.
+    '''
+
+    depth = 0
+
+    def __enter__(self):
+
+        if Transaction.depth:
+            Transaction.depth += 1
+            return self
+
+        self.undoChunk = UndoChunk(force=True)
+        self.undoChunk.__enter__()
+        self.resetAutoKey = None
+        try:
+            self.resetAutoKey = mc.autoKeyframe(query=True, state=True)
+            mc.autoKeyframe(state=False)
+            mc.refresh(suspend=True)
+        except:
+            if self.resetAutoKey is not None:
+                mc.autoKeyframe(state=self.resetAutoKey)
+            self.undoChunk.__exit__()
+            raise
+        Transaction.depth += 1
+        return self
+
+
+    def __exit__(self, *args):
+
+        Transaction.depth -= 1
+        if Transaction.depth:
+            return
+
+        mc.refresh(suspend=False)
+        mc.autoKeyframe(state=self.resetAutoKey)
+        self.undoChunk.__exit__(*args)
+
+
 class UndoChunk():
     '''
     In versions of maya before 2011, python doesn't always undo properly, so in
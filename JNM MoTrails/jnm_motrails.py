@@ -11,15 +11,31 @@ description:
             Cleanup Last: Remove last created motion trail.
             Cleanup All: Remove all motion trails in the scene.
 
-        Doulbe Click - UI: Fade frames and Show Keyframe Number options.
+        Doulbe Click - UI: Fade frames, Show Keyframe Number and Trail color options.
+            Options are saved as a preset and applied to all motion trails, and to new ones when they're created.
             Attributes: Selects motion trails and toggles Attribute Editor to show all options.
 
+    Follow current time: Motion trails only cover the window of frames around the current time, and follow it.
+
+    Adaptive: Static trails, sampled coarsely and refined only where the path bends or moves fast.
+
+    Sampling: World positions for selected objects for playback range or selected range, without creating motion trails.
+        import jnm_motrails;samples = jnm_motrails.sampleMoTrails()
+
     import jnm_motrails;jnm_motrails.win()
 
 """
 import maya.cmds as mc
 import maya.mel as mm
 from maya import OpenMaya
+import maya.api.OpenMaya as om2
+from array import array
+import json
+import math
+try:
+    import numpy as np
+except ImportError:
+    np = None
 author = 'Jose N. Molina'
 version = 1
 website = 'jnmolina.com'
@@ -55,70 +71,343 @@ def checkRangeSelected(*args):
     else:
         return False
 
+# Trail registry, saved as json on a scene node so it lives with the scene.
+# Trails are keyed by source object: {'trails': {obj: {'range': [start, end], 'nodes': [...]}}, 'last': [obj, ...]}
+registry_node = 'jnm_motrails_registry'
+
+def loadRegistry(*args):
+    if mc.objExists(registry_node):
+        data = mc.getAttr(registry_node + '.registry')
+        if data:
+            return json.loads(data)
+    return {'trails': {}, 'last': []}
+
+def saveRegistry(registry):
+    if not mc.objExists(registry_node):
+        mc.createNode('network', name=registry_node, skipSelect=True)
+        mc.addAttr(registry_node, longName='registry', dataType='string')
+    mc.setAttr(registry_node + '.registry', json.dumps(registry), type='string')
+
+# delete the nodes that still exist, in one call
+def deleteNodes(nodes):
+    nodes = mc.ls(nodes)
+    if nodes:
+        mc.delete(nodes)
+
+# check if adaptive trails are turned on in the ui
+def getAdaptive(*args):
+    if mc.window('jnm_motrails_win', q=True, ex=True):
+        global adaptive_box
+        return mc.checkBox(adaptive_box, query=True, value=True) == 1
+    return False
+
+# get the windowed trail size from the ui, None for full range trails
+def getWindow(*args):
+    if mc.window('jnm_motrails_win', q=True, ex=True):
+        global windowed_box
+        if mc.checkBox(windowed_box, query=True, value=True) == 1:
+            global window_frames
+            return mc.intSliderGrp(window_frames, query=True, value=True)
+    return None
+
+# a trail can be reused if it was made with the same settings and all its nodes still exist
+def canReuse(trail, start, end, window, adaptive=False):
+    if not trail or trail.get('window') != window or trail.get('adaptive', False) != adaptive:
+        return False
+    if not window and trail['range'] != [start, end]:
+        return False
+    return len(mc.ls(trail['nodes'])) == len(trail['nodes'])
+
 # Motion Trails
 def setMoTrails(*args):
     sel = objSelected()
     if objSelected():
-        set_global()
         start = None
         end = None
         inc = 1
-        if checkRangeSelected():
+        window = getWindow()
+        adaptive = getAdaptive() and not window
+        if window:
+            t = mc.currentTime(query=True)
+            start, end = t - window, t + window
+        elif checkRangeSelected():
             start, end = getSeletedRange(start, end)
         else:
             start, end = getpbRange(start, end)
+        registry = loadRegistry()
+        trails = registry['trails']
+        # reuse trails that already cover the same range, replace the rest
+        replace = []
+        create = []
+        for obj in sel:
+            trail = trails.get(obj)
+            if canReuse(trail, start, end, window, adaptive):
+                continue
+            if trail:
+                replace.extend(trail['nodes'])
+            create.append(obj)
+        deleteNodes(replace)
         # create motion trails, save for cleanup
-        m = mc.snapshot(sel, motionTrail=True, increment=inc,
-                        startTime=start, endTime=end)
-        global jnm_mts
-        jnm_mts.append(m)
-        # check if ui is open to query checkboxes
-        if mc.window('jnm_motrails_win', q=True, ex=True):
-            global show_keynums_box
-            if mc.checkBox(show_keynums_box, query=True, value=True) == 1:
-                showKeyframeNumbers()
-            global fade_frames_box
-            if mc.checkBox(fade_frames_box, query=True, value=True) == 1:
-                fadeFrames()
+        if adaptive:
+            for obj, curve in zip(create, createAdaptiveTrails(create, start, end)):
+                trails[obj] = {'range': [start, end], 'nodes': [curve],
+                               'window': None, 'adaptive': True}
+        else:
+            for obj in create:
+                m = mc.snapshot(obj, motionTrail=True, increment=inc,
+                                startTime=start, endTime=end)
+                trails[obj] = {'range': [start, end], 'nodes': m, 'window': window}
+        # the last call covers every selected trail, created or reused
+        registry['last'] = [obj for obj in sel if obj in trails]
+        saveRegistry(registry)
+        if window:
+            watchWindowedTrails()
+        if not adaptive:
+            applyPreset(getHandles([trails[obj]['nodes'] for obj in create]))
     else:
         displayWarning('Nothing selected.')
 
+# Windowed trails only cover the frames around the current time. A timeChanged scriptJob queues
+# one deferred update at a time, skipped during playback, and a trail only moves once the time
+# has drifted half a window from its center, so the cost stays the same however long the shot is.
+window_jobs = []
+window_pending = False
+
+def watchWindowedTrails(*args):
+    if window_jobs and mc.scriptJob(exists=window_jobs[0]):
+        return
+    del window_jobs[:]
+    window_jobs.append(mc.scriptJob(event=('timeChanged', queueWindowUpdate)))
+    window_jobs.append(mc.scriptJob(
+        conditionFalse=('playingBack', queueWindowUpdate)))
+
+def queueWindowUpdate(*args):
+    global window_pending
+    if window_pending or mc.play(query=True, state=True):
+        return
+    window_pending = True
+    mc.evalDeferred(updateWindowedTrails, lowestPriority=True)
+
+def updateWindowedTrails(*args):
+    global window_pending
+    window_pending = False
+    windowed = [trail for trail in loadRegistry()['trails'].values()
+                if trail.get('window')]
+    if not windowed:
+        for job in window_jobs:
+            if mc.scriptJob(exists=job):
+                mc.scriptJob(kill=job, force=True)
+        del window_jobs[:]
+        return
+    t = mc.currentTime(query=True)
+    # following the time shouldn't fill the undo queue, restore whatever state it was in
+    undoState = mc.undoInfo(query=True, state=True)
+    mc.undoInfo(stateWithoutFlush=False)
+    try:
+        for trail in windowed:
+            window = trail['window']
+            for node in mc.ls(trail['nodes'], type='motionTrail'):
+                center = (mc.getAttr(node + '.startTime') +
+                          mc.getAttr(node + '.endTime')) / 2.0
+                if abs(t - center) >= window / 2.0:
+                    mc.setAttr(node + '.startTime', t - window)
+                    mc.setAttr(node + '.endTime', t + window)
+    finally:
+        mc.undoInfo(stateWithoutFlush=undoState)
+
 def clearLastMoTrails(*args):
-    for m in get_global():
-        mc.delete(m)
-    set_global()
+    registry = loadRegistry()
+    nodes = []
+    for obj in registry['last']:
+        trail = registry['trails'].pop(obj, None)
+        if trail:
+            nodes.extend(trail['nodes'])
+    registry['last'] = []
+    deleteNodes(nodes)
+    saveRegistry(registry)
 
 def clearAllMoTrails(*args):
-    for each in mc.ls(type='motionTrail'):
-        mc.delete(each)
-
-def set_global(*args):
-    global jnm_mts
-    jnm_mts = []
+    registry = loadRegistry()
+    nodes = mc.ls(type='motionTrail')
+    for trail in registry['trails'].values():
+        nodes.extend(trail['nodes'])
+    deleteNodes(nodes)
+    saveRegistry({'trails': {}, 'last': []})
 
 def get_global(*args):
-    global jnm_mts
-    return jnm_mts
+    return [trail['nodes'] for trail in loadRegistry()['trails'].values()
+            if not trail.get('adaptive')]
+
+# Sample world-space positions by evaluating each object's worldMatrix in a DG context for each frame.
+# The current time is never changed, and nothing is left in the scene to evaluate during playback.
+# Returns {obj: array('d', [x, y, z, x, y, z, ...])} in internal units (cm), one xyz per frame.
+def sampleWorldPositions(objs, frames):
+    sel = om2.MSelectionList()
+    for obj in objs:
+        sel.add(obj)
+    plugs = []
+    for i in range(len(objs)):
+        node = om2.MFnDependencyNode(sel.getDependNode(i))
+        plugs.append(node.findPlug('worldMatrix', False).elementByLogicalIndex(0))
+    samples = dict((obj, array('d')) for obj in objs)
+    unit = om2.MTime.uiUnit()
+    for f in frames:
+        ctx = om2.MDGContext(om2.MTime(f, unit))
+        for obj, plug in zip(objs, plugs):
+            m = om2.MFnMatrixData(plug.asMObject(ctx)).matrix()
+            samples[obj].extend((m[12], m[13], m[14]))
+    return samples
+
+# Sample selected objects over the selected range or playback range, data only
+def sampleMoTrails(inc=1):
+    sel = objSelected()
+    if not sel:
+        return
+    start = None
+    end = None
+    if checkRangeSelected():
+        start, end = getSeletedRange(start, end)
+    else:
+        start, end = getpbRange(start, end)
+    frames = []
+    f = start
+    while f <= end:
+        frames.append(f)
+        f += inc
+    return sampleWorldPositions(mc.ls(sel, type='transform'), frames)
+
+# Flag the intervals between samples that need refining: where the path turns more than angle
+# degrees at either end, or a segment is longer than speed times the average segment.
+def getRefineIntervals(positions, angle=10.0, speed=2.0):
+    if np is not None:
+        p = np.frombuffer(positions, dtype=float).reshape(-1, 3)
+        d = np.diff(p, axis=0)
+        lengths = np.sqrt((d * d).sum(axis=1))
+        turns = np.zeros(len(p))
+        lengthProducts = lengths[:-1] * lengths[1:]
+        moving = lengthProducts > 0
+        cos = (d[:-1] * d[1:]).sum(axis=1)[moving] / lengthProducts[moving]
+        turns[1:-1][moving] = np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+        fast = lengths > speed * lengths.mean() if len(lengths) else lengths > 0
+        return ((turns[:-1] > angle) | (turns[1:] > angle) | fast).tolist()
+    p = [positions[i:i + 3] for i in range(0, len(positions), 3)]
+    d = [[b[j] - a[j] for j in range(3)] for a, b in zip(p, p[1:])]
+    lengths = [math.sqrt(sum(x * x for x in v)) for v in d]
+    turns = [0.0] * len(p)
+    for i in range(1, len(p) - 1):
+        if lengths[i - 1] and lengths[i]:
+            cos = sum(a * b for a, b in zip(d[i - 1], d[i])) / (lengths[i - 1] * lengths[i])
+            turns[i] = math.degrees(math.acos(max(-1.0, min(1.0, cos))))
+    average = sum(lengths) / len(lengths) if lengths else 0.0
+    return [turns[i] > angle or turns[i + 1] > angle or lengths[i] > speed * average
+            for i in range(len(lengths))]
+
+# Sample every coarse frames, then every frame only in the intervals that bend or move fast.
+# Returns {obj: (frames, positions)} with a non-uniform frame list per object.
+def sampleAdaptive(objs, start, end, coarse=4, angle=10.0, speed=2.0):
+    frames = []
+    f = start
+    while f < end:
+        frames.append(f)
+        f += coarse
+    frames.append(end)
+    coarseSamples = sampleWorldPositions(objs, frames)
+    samples = {}
+    for obj in objs:
+        refine = []
+        for i, flagged in enumerate(getRefineIntervals(coarseSamples[obj], angle, speed)):
+            if flagged:
+                f = frames[i] + 1
+                while f < frames[i + 1]:
+                    refine.append(f)
+                    f += 1
+        if refine:
+            fineSamples = sampleWorldPositions([obj], refine)[obj]
+            merged = sorted([(f, coarseSamples[obj][i * 3:i * 3 + 3]) for i, f in enumerate(frames)] +
+                            [(f, fineSamples[i * 3:i * 3 + 3]) for i, f in enumerate(refine)])
+            positions = array('d')
+            for f, p in merged:
+                positions.extend(p)
+            samples[obj] = ([f for f, p in merged], positions)
+        else:
+            samples[obj] = (frames, coarseSamples[obj])
+    return samples
+
+# Adaptive trails are linear curves through the adaptive samples. They're static,
+# so they cost nothing during playback. Returns the curves in the order of objs.
+def createAdaptiveTrails(objs, start, end):
+    samples = sampleAdaptive(objs, start, end)
+    curves = []
+    for obj in objs:
+        frames, positions = samples[obj]
+        points = [tuple(om2.MDistance.internalToUI(x) for x in positions[i:i + 3])
+                  for i in range(0, len(positions), 3)]
+        curves.append(mc.curve(degree=1, point=points,
+                               name=obj.split('|')[-1].replace(':', '_') + '_adaptiveTrail#'))
+    return curves
+
+# Display presets are stored once in an optionVar and applied to every trail when it's created.
+preset_var = 'jnm_motrails_preset'
+default_preset = {'showFrames': False, 'fadeInoutFrames': 0, 'preFrame': 0, 'postFrame': 0,
+                  'trailColor': None}
+
+def loadPreset(*args):
+    preset = dict(default_preset)
+    if mc.optionVar(exists=preset_var):
+        preset.update(json.loads(mc.optionVar(query=preset_var)))
+    return preset
+
+def savePreset(preset):
+    mc.optionVar(stringValue=(preset_var, json.dumps(preset)))
+
+def getHandles(mts=None):
+    if mts is None:
+        mts = get_global()
+    return mc.ls([x[i] for x in mts for i in range(0, len(x), 2)])
+
+# Apply a preset to the handles in a single mel batch, so it's one command however many trails there are.
+def applyPreset(handles=None, preset=None):
+    if handles is None:
+        handles = getHandles()
+    if preset is None:
+        preset = loadPreset()
+    if not handles:
+        return
+    cmds = []
+    for handle in handles:
+        cmds.append('setAttr "%s.showFrames" %d;' % (handle, preset['showFrames']))
+        for attr in ('fadeInoutFrames', 'preFrame', 'postFrame'):
+            cmds.append('setAttr "%s.%s" %d;' % (handle, attr, preset[attr]))
+        if preset['trailColor']:
+            cmds.append('setAttr "%s.trailColor" -type double3 %f %f %f;' %
+                        ((handle,) + tuple(preset['trailColor'])))
+    mm.eval('\n'.join(cmds))
+
+# Update the stored preset and apply it to all trails in the scene.
+def setPreset(**kwargs):
+    preset = loadPreset()
+    preset.update(kwargs)
+    savePreset(preset)
+    applyPreset(preset=preset)
 
 def showAttributes(*args):
-    mts = get_global()
-    handles = [x[i] for x in mts for i in range(0, len(x), 2)]
-    mc.select(handles)
+    mc.select(getHandles())
     mm.eval('ToggleAttributeEditor')
 
-def showKeyframeNumbers(*args):
-    mts = get_global()
-    handles = [x[i] for x in mts for i in range(0, len(x), 2)]
-    for handle in handles:
-        mc.setAttr(handle + '.showFrames', 1)
+def showKeyframeNumbers(value=True, *args):
+    setPreset(showFrames=bool(value))
 
-def fadeFrames(*args):
-    mts = get_global()
-    handles = [x[i] for x in mts for i in range(0, len(x), 2)]
-    for handle in handles:
-        mc.setAttr(handle + '.fadeInoutFrames', 10)
-        mc.setAttr(handle + '.preFrame', 10)
-        mc.setAttr(handle + '.postFrame', 10)
+def fadeFrames(value=True, *args):
+    frames = 10 if value else 0
+    setPreset(fadeInoutFrames=frames, preFrame=frames, postFrame=frames)
+
+def trailColor(*args):
+    global color_box
+    global color_slider
+    if mc.checkBox(color_box, query=True, value=True) == 1:
+        setPreset(trailColor=mc.colorSliderGrp(color_slider, query=True, rgbValue=True))
+    else:
+        setPreset(trailColor=None)
 
 def about(*args):
     text = 'Author: ' + author + '\n\n' + 'Version: ' + \
@@ -129,8 +418,11 @@ motrails_anno = 'Create Motion Trail for selected on selected range or playback
 cleanupLastMoTrails_anno = 'Remove last created motion trail(s).'
 cleanupAllMoTrails_anno = 'Remove all motion trail(s).'
 showAttributes_anno = 'Selects motrail(s), toggles Attribute Editor.'
-fadeFrames_anno = 'Fade frames of the motion trails whencreated.'
-show_keynums_anno = 'Show keyframe numbers for the motion trails.'
+fadeFrames_anno = 'Fade frames of the motion trails, saved and applied when created.'
+show_keynums_anno = 'Show keyframe numbers for the motion trails, saved and applied when created.'
+trailColor_anno = 'Color of the motion trails, saved and applied when created.'
+adaptive_anno = 'Create static trails sampled densely only where the path bends or moves fast.'
+windowed_anno = 'Create motion trails that only cover the frames around the current time, and follow it.'
 
 w = 300
 
@@ -157,12 +449,31 @@ def win(*args):
     mc.setParent('..')
     mc.columnLayout(adjustableColumn=True)
     mc.separator(style='single', horizontal=True, h=10)
+    preset = loadPreset()
     global show_keynums_box
     show_keynums_box = mc.checkBox(
-        label='Show Keyframe Numbers', annotation=show_keynums_anno)
+        label='Show Keyframe Numbers', annotation=show_keynums_anno,
+        value=preset['showFrames'], changeCommand=showKeyframeNumbers)
     global fade_frames_box
     fade_frames_box = mc.checkBox(
-        label='Fade frames', annotation=fadeFrames_anno)
+        label='Fade frames', annotation=fadeFrames_anno,
+        value=preset['fadeInoutFrames'] > 0, changeCommand=fadeFrames)
+    global color_box
+    color_box = mc.checkBox(
+        label='Trail color', annotation=trailColor_anno,
+        value=preset['trailColor'] is not None, changeCommand=trailColor)
+    global color_slider
+    color_slider = mc.colorSliderGrp(label='Color', rgb=preset['trailColor'] or (1, 1, 1),
+                                     annotation=trailColor_anno, changeCommand=trailColor)
+    global windowed_box
+    windowed_box = mc.checkBox(
+        label='Follow current time', annotation=windowed_anno)
+    global adaptive_box
+    adaptive_box = mc.checkBox(
+        label='Adaptive', annotation=adaptive_anno)
+    global window_frames
+    window_frames = mc.intSliderGrp(label='Window', minValue=1, maxValue=100,
+                                    value=10, field=True, annotation=windowed_anno)
     mc.setParent('..')
     mc.columnLayout(adjustableColumn=True)
     mc.helpLine()
@@ -22,6 +22,7 @@ description:
 from maya import OpenMaya
 import maya.mel as mm
 import maya.cmds as mc
+import bisect
 author = 'Jose N. Molina'
 version = 1
 website = 'jnmolina.com'
@@ -86,32 +87,118 @@ def getSelectedChannels():
 def getChannelFromAnimCurve(curve, plugs=True):
     '''
     Finding the channel associated with a curve has gotten really complicated since animation layers.
-    This is a recursive function which walks connections from a curve until an animated channel is found.
+    This walks connections from a curve until an animated channel is found.
     '''
+    return getChannelsFromAnimCurves([curve], plugs=plugs)[0]
 
-    # we need to save the attribute for later.
-    attr = ''
-    if '.' in curve:
-        curve, attr = curve.split('.')
-
-    nodeType = mc.nodeType(curve)
-    if nodeType.startswith('animCurveT') or nodeType.startswith('animBlendNode'):
-        source = mc.listConnections(curve+'.output', source=False, plugs=plugs)
-        if not source and nodeType == 'animBlendNodeAdditiveRotation':
-            # if we haven't found a connection from .output, then it may be a node that uses outputX, outputY, etc.
-            # get the proper attribute by using the last letter of the input attribute, which should be X, Y, etc.
-            # if we're not returning plugs, then we wont have an attr suffix to use, so just use X.
-            attrSuffix = 'X'
-            if plugs:
-                attrSuffix = attr[-1]
-
-            source = mc.listConnections(
-                curve+'.output'+attrSuffix, source=False, plugs=plugs)
-        if source:
-            nodeType = mc.nodeType(source[0])
+
+# curve to channel results, cleared whenever a connection is made or broken, or a node is deleted or renamed
+_channelMemo = dict()
+_channelMemoCallbacks = list()
+
+
+def clearChannelMemo(*args):
+    _channelMemo.clear()
+
+
+def unwatchChannelMemo(*args):
+    '''
+    Removes the memo callbacks and clears it, this runs before a new scene or file is opened.
+    '''
+    for callback in _channelMemoCallbacks:
+        try:
+            OpenMaya.MMessage.removeCallback(callback)
+        except RuntimeError:
+            pass
+    del _channelMemoCallbacks[:]
+    clearChannelMemo()
+
+
+def _watchChannelMemo():
+    if _channelMemoCallbacks:
+        return
+    _channelMemoCallbacks.append(
+        OpenMaya.MDGMessage.addConnectionCallback(clearChannelMemo))
+    _channelMemoCallbacks.append(
+        OpenMaya.MDGMessage.addNodeRemovedCallback(clearChannelMemo, 'dependNode'))
+    _channelMemoCallbacks.append(
+        OpenMaya.MNodeMessage.addNameChangedCallback(OpenMaya.MObject(), clearChannelMemo))
+    for message in (OpenMaya.MSceneMessage.kBeforeNew, OpenMaya.MSceneMessage.kBeforeOpen):
+        _channelMemoCallbacks.append(
+            OpenMaya.MSceneMessage.addCallback(message, unwatchChannelMemo))
+
+
+def getChannelsFromAnimCurves(curves, plugs=True):
+    '''
+    Returns the animated channel for each curve in a list, in the same order, or None where there isn't one.
+    Animation layer blend nodes are walked breadth first, with one connection query for each level of the graph.
+    Results are memoized until the graph changes.
+    '''
+
+    _watchChannelMemo()
+
+    result = [None]*len(curves)
+    # curves passed in more than once are only walked once
+    first = dict()
+    # walk the plugs of every curve that isn't memoized yet, as index, node, attr, node type
+    frontier = list()
+    for i, c in enumerate(curves):
+        if c in first:
+            continue
+        if (c, plugs) in _channelMemo:
+            first[c] = i
+            result[i] = _channelMemo[(c, plugs)]
+            continue
+        first[c] = i
+        node, _, attr = c.partition('.')
+        frontier.append((i, node, attr, None))
+
+    while frontier:
+        # one query for the whole level, only the first connection of each plug is used
+        destinations = dict()
+        connections = mc.listConnections(list(set(n+'.output' for i, n, a, t in frontier)),
+                                         source=False, plugs=True, connections=True) or []
+        for j in range(0, len(connections), 2):
+            destinations.setdefault(connections[j], connections[j+1])
+
+        # if we haven't found a connection from .output, then it may be a node that uses outputX, outputY, etc.
+        # get the proper attribute by using the last letter of the input attribute, which should be X, Y, etc.
+        sources = list()
+        for i, n, a, t in frontier:
+            if n+'.output' not in destinations and t == 'animBlendNodeAdditiveRotation':
+                sources.append(n+'.output'+(a[-1] if a else 'X'))
+            else:
+                sources.append(n+'.output')
+        missing = list(set(x for x in sources
+                           if x not in destinations and not x.endswith('.output')))
+        if missing:
+            connections = mc.listConnections(missing, source=False,
+                                             plugs=True, connections=True) or []
+            for j in range(0, len(connections), 2):
+                destinations.setdefault(connections[j], connections[j+1])
+
+        nodeTypes = dict()
+        if destinations:
+            showType = mc.ls(list(set(x.split('.')[0]
+                                      for x in destinations.values())), showType=True) or []
+            nodeTypes = dict(zip(showType[::2], showType[1::2]))
+
+        nextFrontier = list()
+        for (i, n, a, t), source in zip(frontier, sources):
+            if source not in destinations:
+                continue
+            node, _, attr = destinations[source].partition('.')
+            nodeType = nodeTypes.get(node) or mc.nodeType(node)
             if nodeType.startswith('animCurveT') or nodeType.startswith('animBlendNode'):
-                return getChannelFromAnimCurve(source[0], plugs=plugs)
-            return source[0]
+                nextFrontier.append((i, node, attr, nodeType))
+            else:
+                result[i] = destinations[source] if plugs else node
+        frontier = nextFrontier
+
+    for i, c in enumerate(curves):
+        result[i] = result[first[c]]
+        _channelMemo[(c, plugs)] = result[i]
+    return result
 
 
 def getSelectedAnimLayers():
@@ -125,6 +212,132 @@ def getSelectedAnimLayers():
     return layers
 
 
+class KeyIndex(object):
+    '''
+    Sorted key times, fetched with a single keyframe query.
+    Arguments are passed on to the keyframe command, so this can index the selection,
+    a list of curves or nodes, or a single attribute. Range, key-at-frame and
+    next/previous lookups are answered with bisect instead of querying maya.
+    '''
+
+    def __init__(self, *args, **kwargs):
+
+        keyTimes = mc.keyframe(*args, query=True, timeChange=True, **kwargs)
+        self.times = sorted(set(keyTimes)) if keyTimes else list()
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def __iter__(self):
+        return iter(self.times)
+
+
+    def inRange(self, start, end):
+        '''
+        Returns key times from start up to, but not including, end. Sub-frame keys are included.
+        '''
+        return self.times[bisect.bisect_left(self.times, start):bisect.bisect_left(self.times, end)]
+
+
+    def keyAt(self, time, tolerance=0.0):
+        '''
+        Returns True if there's a key within tolerance of the time.
+        '''
+        i = bisect.bisect_left(self.times, time-tolerance)
+        return i < len(self.times) and self.times[i] <= time+tolerance
+
+
+    def nextKey(self, time):
+        '''
+        Returns the first key after the time, or None.
+        '''
+        i = bisect.bisect_right(self.times, time)
+        if i < len(self.times):
+            return self.times[i]
+
+
+    def previousKey(self, time):
+        '''
+        Returns the last key before the time, or None.
+        '''
+        i = bisect.bisect_left(self.times, time)
+        if i:
+            return self.times[i-1]
+
+
+    def firstKey(self):
+        if self.times:
+            return self.times[0]
+
+
+    def lastKey(self):
+        if self.times:
+            return self.times[-1]
+
+class UndoChunk():
+    '''
+    In versions of maya before 2011, python doesn't always undo properly, so in
+    some cases we have to manage the undo queue ourselves.
+    '''
+
+    def __init__(self, force=False):
+        self.force = force
+
+    def __enter__(self):
+        '''open the undo chunk'''
+        if self.force or MAYA_VERSION < 2011:
+            self.force = True
+            mc.undoInfo(openChunk=True)
+
+    def __exit__(self, *args):
+        '''close the undo chunk'''
+        if self.force:
+            mc.undoInfo(closeChunk=True)
+
+
+class Transaction():
+    '''
+    Wraps a whole operation in one undo chunk, and suspends refresh and turns off autokey
+    once for the duration instead of around every edit. Nested transactions are absorbed
+    by the outermost one.
+    '''
+
+    depth = 0
+
+    def __enter__(self):
+
+        if Transaction.depth:
+            Transaction.depth += 1
+            return self
+
+        self.undoChunk = UndoChunk(force=True)
+        self.undoChunk.__enter__()
+        self.resetAutoKey = None
+        try:
+            self.resetAutoKey = mc.autoKeyframe(query=True, state=True)
+            mc.autoKeyframe(state=False)
+            mc.refresh(suspend=True)
+        except:
+            if self.resetAutoKey is not None:
+                mc.autoKeyframe(state=self.resetAutoKey)
+            self.undoChunk.__exit__()
+            raise
+        Transaction.depth += 1
+        return self
+
+
+    def __exit__(self, *args):
+
+        Transaction.depth -= 1
+        if Transaction.depth:
+            return
+
+        mc.refresh(suspend=False)
+        mc.autoKeyframe(state=self.resetAutoKey)
+        self.undoChunk.__exit__(*args)
+
 MAYA_VERSION = mm.eval('getApplicationVersionAsFloat')
 
 def createShelfButton(command, label='', name=None, description='', image=None, labelColor=(1, 0.5, 0), labelBackgroundColor=(0, 0, 0, 0.5), backgroundColor=None):
@@ -225,20 +438,17 @@ def keyExists(t, channel=None):
         else:
             return True
 
-# get frames that have keyframes
+# get the sorted key times of the selection, or of a channel, in one query
+
+def getKeyIndex(channel=None):
+    if channel != None:
+        return KeyIndex(at=channel)
+    return KeyIndex()
+
+# get frames that have keyframes, including sub-frames
 
 def getKeysInRange(start, end, channel=None):
-    keys = []
-    mc.refresh(suspend=True)
-    for x in range(int(start), int(end)):
-        if channel != None:
-            if keyExists(x, channel):
-                keys.append(int(x))
-        else:
-            if keyExists(x):
-                keys.append(int(x))
-    mc.refresh(suspend=False)
-    return keys
+    return getKeyIndex(channel).inRange(start, end)
 
 # check if timeline range is selected
 
@@ -257,126 +467,168 @@ def keyCount(*args):
 # Move timeline keys
 
 def moveKey(time, new_time, option, channel=None):
-    mc.refresh(suspend=True)
     if channel != None:
         mc.keyframe(edit=True, time=(time,), option=option,
-                    timeChange=int(new_time), at=channel)
+                    timeChange=new_time, at=channel)
     else:
         mc.keyframe(edit=True, time=(time,), option=option,
-                    timeChange=int(new_time))
-    mc.refresh(suspend=False)
+                    timeChange=new_time)
 
 # Move selected keys in Graph Editor
 
 def moveSelectedKeys(step):
-    mc.refresh(suspend=True)
     mc.keyframe(edit=True, animation='keysOrObjects',
                 option='move', relative=True, timeChange=int(step))
-    mc.refresh(suspend=False)
+
+# Move the keys in the range as one block, checked against the channel's other keys in memory
+
+def moveKeyBlock(start, end, offset, channel=None):
+    keyIndex = getKeyIndex(channel)
+    keys = keyIndex.inRange(start, end)
+    if not keys:
+        return
+    for k in keys:
+        new_time = k + offset
+        if keyIndex.keyAt(new_time) and not keys[0] <= new_time <= keys[-1]:
+            displayWarning('Unable to move keys.')
+            return
+    if channel != None:
+        mc.keyframe(edit=True, time=(keys[0], keys[-1]), option='over',
+                    relative=True, timeChange=offset, at=channel)
+    else:
+        mc.keyframe(edit=True, time=(keys[0], keys[-1]), option='over',
+                    relative=True, timeChange=offset)
+    return keys[-1] + offset
+
+# sorted key times for each channel of the selection, from one key query for all of their curves.
+# each curve's times are grouped under the short and long names of the attribute it drives.
+
+def getChannelKeyTimes(channels):
+    keyTimes = dict((c, set()) for c in channels)
+    curves = mc.keyframe(query=True, name=True, at=channels)
+    if not curves:
+        return dict((c, []) for c in channels)
+    # index values start over at 0 for each curve
+    times = mc.keyframe(curves, query=True, timeChange=True) or []
+    starts = [i for i, x in enumerate(
+        mc.keyframe(curves, query=True, indexValue=True) or []) if x == 0]
+    if len(starts) != len(curves):
+        return dict((c, getKeyIndex(c).times) for c in channels)
+    starts.append(len(times))
+    for i, plug in enumerate(getChannelsFromAnimCurves(curves)):
+        if not plug:
+            continue
+        selection = OpenMaya.MSelectionList()
+        selection.add(plug)
+        mplug = OpenMaya.MPlug()
+        selection.getPlug(0, mplug)
+        for name in (mplug.partialName(), mplug.partialName(False, False, False, False, False, True)):
+            if name in keyTimes:
+                keyTimes[name].update(times[starts[i]:starts[i + 1]])
+    return dict((c, sorted(t)) for c, t in keyTimes.items())
+
+# Move the previous/next key to the current time. Keys are found from one key query for all channels
+# and moved by explicit channel and time, without touching the key selection.
+# Channels that share the same key to move are moved together.
 
 def keyMove(t, direction, *args):
     channels = getSelectedChannels()
     if len(channels) > 0:
+        moves = {}
+        keyTimes = getChannelKeyTimes(channels)
         for c in channels:
-            mc.selectKey(at=c)
-            next = mc.findKeyframe(time=(t,), which='next')
-            prev = mc.findKeyframe(time=(t,), which='previous')
-            mc.selectKey(clear=True)
+            times = keyTimes[c]
+            k = None
             if direction == 'right':
-                mc.selectKey(at=c,time=(prev,prev))
-                step = t - prev
-                moveSelectedKeys(step)
-                mc.selectKey(clear=True)
+                i = bisect.bisect_left(times, t)
+                if i:
+                    k = times[i-1]
             elif direction == 'left':
-                mc.selectKey(at=c,time=(next,next))
-                step = next - t
-                moveSelectedKeys(-step)
-                mc.selectKey(clear=True)
+                i = bisect.bisect_right(times, t)
+                if i < len(times):
+                    k = times[i]
+            if k != None:
+                moves.setdefault(k, []).append(c)
+        for k in sorted(moves):
+            moveKey(k, t, 'over', channel=moves[k])
     else:
-        next = mc.findKeyframe(time=(t,), which='next')
-        prev = mc.findKeyframe(time=(t,), which='previous')
+        keyIndex = getKeyIndex()
         if direction == 'right':
-            moveKey(prev,t,'over')
+            prev = keyIndex.previousKey(t)
+            if prev != None:
+                moveKey(prev, t, 'over')
         elif direction == 'left':
-            moveKey(next,t,'over')
+            next = keyIndex.nextKey(t)
+            if next != None:
+                moveKey(next, t, 'over')
 
-# Move keyframes by value selected
+# Move keyframes by value selected, as one undo step
 # order: curve keys, prev/next key moves, current key moves
 def moveKeys(direction):
-    start = None
-    end = None
-    new_time = None
-    try:
-        step = getStepTime()
-    except:
-        step = 1
-    if objSelected():
-        if keyCount() != None:
-            if direction == 'right':
-                moveSelectedKeys(step)
-            elif direction == 'left':
-                moveSelectedKeys('-'+str(step))
-        else:
-            t = mc.currentTime(query=True)
-            currentKey = keyExists(t)
-            if not currentKey:
-                keyMove(t,direction)
+    with Transaction():
+        start = None
+        end = None
+        new_time = None
+        try:
+            step = getStepTime()
+        except:
+            step = 1
+        if objSelected():
+            if keyCount() != None:
+                if direction == 'right':
+                    moveSelectedKeys(step)
+                elif direction == 'left':
+                    moveSelectedKeys('-'+str(step))
             else:
-                channels = getSelectedChannels()
-                if len(channels) > 0:
-                    if checkRangeSelected():
-                        start, end = getSeletedRange(start, end)
-                        for c in channels:
-                            keys = getKeysInRange(start, end, channel=c)
-                            for k in keys:  # frames with keys
-                                if direction == 'right':
-                                    new_time = k + step
-                                elif direction == 'left':
-                                    new_time = k - step
+                offset = step
+                if direction == 'left':
+                    offset = -step
+                t = mc.currentTime(query=True)
+                currentKey = keyExists(t)
+                if not currentKey:
+                    keyMove(t,direction)
+                else:
+                    channels = getSelectedChannels()
+                    if len(channels) > 0:
+                        if checkRangeSelected():
+                            start, end = getSeletedRange(start, end)
+                            for c in channels:
+                                block_time = moveKeyBlock(start, end, offset, channel=c)
+                                if block_time != None:
+                                    new_time = block_time
+                            if new_time != None:
+                                mc.currentTime(new_time)
+                        else:
+                            time = getTime()
+                            if direction == 'right':
+                                new_time = time + step
+                            elif direction == 'left':
+                                new_time = time - step
+                            for c in channels:
                                 if not mc.keyframe(query=True, time=(new_time,), at=c):
-                                    moveKey(k, new_time, option='over', channel=c)
+                                    moveKey(time, new_time, option='over', channel=c)
                                 else:
                                     displayWarning('Unable to move keys.')
-                        mc.currentTime(new_time)
+                            mc.currentTime(new_time)
                     else:
-                        time = getTime()
-                        if direction == 'right':
-                            new_time = time + step
-                        elif direction == 'left':
-                            new_time = time - step
-                        for c in channels:
-                            if not mc.keyframe(query=True, time=(new_time,), at=c):
-                                moveKey(time, new_time, option='over', channel=c)
-                            else:
-                                displayWarning('Unable to move keys.')
-                        mc.currentTime(new_time)
-                else:
-                    if checkRangeSelected():
-                        start, end = getSeletedRange(start, end)
-                        keys = keys = getKeysInRange(start, end)
-                        for k in keys:  # frames with keys
+                        if checkRangeSelected():
+                            start, end = getSeletedRange(start, end)
+                            new_time = moveKeyBlock(start, end, offset)
+                            if new_time != None:
+                                mc.currentTime(new_time)
+                        else:
+                            time = getTime()
                             if direction == 'right':
-                                new_time = k + step
+                                new_time = time + step
                             elif direction == 'left':
-                                new_time = k - step
+                                new_time = time - step
                             if not mc.keyframe(query=True, time=(new_time,)):
-                                moveKey(k, new_time, option='over')
+                                moveKey(time, new_time, option='over')
                             else:
                                 displayWarning('Unable to move keys.')
-                        mc.currentTime(new_time)
-                    else:
-                        time = getTime()
-                        if direction == 'right':
-                            new_time = time + step
-                        elif direction == 'left':
-                            new_time = time - step
-                        if not mc.keyframe(query=True, time=(new_time,)):
-                            moveKey(time, new_time, option='over')
-                        else:
-                            displayWarning('Unable to move keys.')
-                        mc.currentTime(new_time)
-    else:
-        displayWarning('Nothing selected.')
+                            mc.currentTime(new_time)
+        else:
+            displayWarning('Nothing selected.')
 
 left_btn_ann = 'Move keys to the left.'
 right_btn_ann = 'Move keys to the right.'
@@ -14,6 +14,11 @@ description:
 import maya.cmds as mc
 import maya.mel as mm
 from maya import OpenMaya
+import bisect
+try:
+    import numpy as np
+except ImportError:
+    np = None
 author = 'Jose N. Molina'
 version = 1
 website = 'jnmolina.com'
@@ -72,6 +77,134 @@ def getSelectedChannels():
 
     return channels
 
+class KeyIndex(object):
+    '''
+    Sorted key times, fetched with a single keyframe query.
+    Arguments are passed on to the keyframe command, so this can index the selection,
+    a list of curves or nodes, or a single attribute. Range, key-at-frame and
+    next/previous lookups are answered with bisect instead of querying maya.
+    '''
+
+    def __init__(self, *args, **kwargs):
+
+        keyTimes = mc.keyframe(*args, query=True, timeChange=True, **kwargs)
+        self.times = sorted(set(keyTimes)) if keyTimes else list()
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def __iter__(self):
+        return iter(self.times)
+
+
+    def inRange(self, start, end):
+        '''
+        Returns key times from start up to, but not including, end. Sub-frame keys are included.
+        '''
+        return self.times[bisect.bisect_left(self.times, start):bisect.bisect_left(self.times, end)]
+
+
+    def keyAt(self, time, tolerance=0.0):
+        '''
+        Returns True if there's a key within tolerance of the time.
+        '''
+        i = bisect.bisect_left(self.times, time-tolerance)
+        return i < len(self.times) and self.times[i] <= time+tolerance
+
+
+    def nextKey(self, time):
+        '''
+        Returns the first key after the time, or None.
+        '''
+        i = bisect.bisect_right(self.times, time)
+        if i < len(self.times):
+            return self.times[i]
+
+
+    def previousKey(self, time):
+        '''
+        Returns the last key before the time, or None.
+        '''
+        i = bisect.bisect_left(self.times, time)
+        if i:
+            return self.times[i-1]
+
+
+    def firstKey(self):
+        if self.times:
+            return self.times[0]
+
+
+    def lastKey(self):
+        if self.times:
+            return self.times[-1]
+
+MAYA_VERSION = mm.eval('getApplicationVersionAsFloat')
+
+class UndoChunk():
+    '''
+    In versions of maya before 2011, python doesn't always undo properly, so in
+    some cases we have to manage the undo queue ourselves.
+    '''
+
+    def __init__(self, force=False):
+        self.force = force
+
+    def __enter__(self):
+        '''open the undo chunk'''
+        if self.force or MAYA_VERSION < 2011:
+            self.force = True
+            mc.undoInfo(openChunk=True)
+
+    def __exit__(self, *args):
+        '''close the undo chunk'''
+        if self.force:
+            mc.undoInfo(closeChunk=True)
+
+
+class Transaction():
+    '''
+    Wraps a whole operation in one undo chunk, and suspends refresh and turns off autokey
+    once for the duration instead of around every edit. Nested transactions are absorbed
+    by the outermost one.
+    '''
+
+    depth = 0
+
+    def __enter__(self):
+
+        if Transaction.depth:
+            Transaction.depth += 1
+            return self
+
+        self.undoChunk = UndoChunk(force=True)
+        self.undoChunk.__enter__()
+        self.resetAutoKey = None
+        try:
+            self.resetAutoKey = mc.autoKeyframe(query=True, state=True)
+            mc.autoKeyframe(state=False)
+            mc.refresh(suspend=True)
+        except:
+            if self.resetAutoKey is not None:
+                mc.autoKeyframe(state=self.resetAutoKey)
+            self.undoChunk.__exit__()
+            raise
+        Transaction.depth += 1
+        return self
+
+
+    def __exit__(self, *args):
+
+        Transaction.depth -= 1
+        if Transaction.depth:
+            return
+
+        mc.refresh(suspend=False)
+        mc.autoKeyframe(state=self.resetAutoKey)
+        self.undoChunk.__exit__(*args)
+
 # JNM scripts
 
 def displayWarning(text):
@@ -103,20 +236,17 @@ def keyExists(t, channel=None):
         else:
             return True
 
-# get frames that have keyframes
+# get the sorted key times of the selection, or of a channel, in one query
+
+def getKeyIndex(channel=None):
+    if channel != None:
+        return KeyIndex(at=channel)
+    return KeyIndex()
+
+# get frames that have keyframes, including sub-frames
 
 def getKeysInRange(start, end, channel=None):
-    keys = []
-    mc.refresh(suspend=True)
-    for x in range(int(start), int(end)):
-        if channel != None:
-            if keyExists(x, channel):
-                keys.append(int(x))
-        else:
-            if keyExists(x):
-                keys.append(int(x))
-    mc.refresh(suspend=False)
-    return keys
+    return getKeyIndex(channel).inRange(start, end)
 
 # check if timeline range is selected
 
@@ -132,73 +262,177 @@ def keyCount(*args):
     count = mc.keyframe(query=True, timeChange=True, selected=True)
     return count
 
-# Move timeline keys
+# map each key in the range to its re-timed slot, stepping from the first key
 
-def moveKey(time, new_time, option, channel=None):
-    mc.refresh(suspend=True)
-    if channel != None:
-        mc.keyframe(edit=True, time=(time,), option=option,
-                    timeChange=int(new_time), at=channel)
-    else:
-        mc.keyframe(edit=True, time=(time,), option=option,
-                    timeChange=int(new_time))
-    mc.refresh(suspend=False)
+def getRetimeMap(keys, step):
+    return [(k, keys[0] + i * step) for i, k in enumerate(keys)]
 
-# Re-time keys from first key by value selected
+# group keys that shift by the same amount into runs, ordered so no key lands on one that hasn't moved yet
+# keys moving left go first to last, keys moving right go last to first
 
-def retimeSelectedKeys(*args):
-    start = None
-    end = None
-    new_time = None
-    step = getStepTime()
-    if keyCount() != None:
-        displayWarning(
-            'Unable to re-time curves. Please select a channel and re-time on the timeline.')
+def getRetimeMoves(retimeMap):
+    runs = []
+    for old, new in retimeMap:
+        offset = new - old
+        if runs and abs(runs[-1][2] - offset) < 0.0001:
+            runs[-1][1] = old
+        else:
+            runs.append([old, old, offset])
+    left = [tuple(r) for r in runs if r[2] < -0.0001]
+    right = [tuple(r) for r in reversed(runs) if r[2] > 0.0001]
+    return left + right
+
+# same as getRetimeMoves, for every channel's keys in one vectorized pass
+
+def getRetimeMovesArray(keyLists, step):
+    counts = np.array([len(k) for k in keyLists], dtype=int)
+    times = np.array([t for k in keyLists for t in k], dtype=float)
+    moves = [[] for k in keyLists]
+    if not len(times):
+        return moves
+    owner = np.repeat(np.arange(len(keyLists)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    rank = np.arange(len(times)) - first
+    offsets = times[first] + rank * step - times
+    # a run starts on each channel's first key, or wherever the offset changes
+    breaks = np.ones(len(times), dtype=bool)
+    breaks[1:] = (owner[1:] != owner[:-1]) | (
+        np.abs(np.diff(offsets)) >= 0.0001)
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], len(times)) - 1
+    for o, first_time, last_time, offset in zip(owner[starts], times[starts], times[ends], offsets[starts]):
+        moves[o].append((float(first_time), float(last_time), float(offset)))
+    for i, runs in enumerate(moves):
+        left = [r for r in runs if r[2] < -0.0001]
+        right = [r for r in reversed(runs) if r[2] > 0.0001]
+        moves[i] = left + right
+    return moves
+
+# keys after the range stay put, so nothing can be re-timed onto them
+
+def retimeCollides(keyIndex, keys, step, end):
+    for t in keyIndex.inRange(end, keys[0] + len(keys) * step):
+        i = (t - keys[0]) / float(step)
+        if abs(i - round(i)) < 0.0001:
+            return True
+    return False
+
+# plan the re-time for every channel from one key query each,
+# channels that end up with the same moves are grouped so they're edited together
+
+def planRetime(start, end, step, channels=None):
+    if not channels:
+        channels = [None]
+    keyIndexes = [getKeyIndex(c) for c in channels]
+    keyLists = [k.inRange(start, end) for k in keyIndexes]
+    if np is None:
+        moves = [getRetimeMoves(getRetimeMap(k, step)) if k else []
+                 for k in keyLists]
     else:
-        channels = getSelectedChannels()
-        if len(channels) != 0:
-            if checkRangeSelected():
-                start, end = getSeletedRange(start, end)
-                for c in channels:
-                    keys = getKeysInRange(start, end, channel=c)
-                    first_key = keys[0]
-                    new_time = first_key
-                    # first move keys out of the way
-                    temp_keys = []
-                    for k in keys:
-                        temp_time = k + 1000
-                        temp_keys.append(temp_time)
-                        moveKey(k, temp_time, option='over', channel=c)
-                    # retime keys from first key by value selected
-                    new_time = first_key
-                    for k in temp_keys:
-                        moveKey(k, new_time, option='over', channel=c)
-                        new_time += step
-            else:
-                displayWarning('No keys on the timeline selected.')
+        moves = getRetimeMovesArray(keyLists, step)
+    plan = []
+    groups = {}
+    new_time = None
+    for c, keyIndex, keys, m in zip(channels, keyIndexes, keyLists, moves):
+        if not keys:
+            continue
+        if retimeCollides(keyIndex, keys, step, end):
+            displayWarning('Unable to re-time keys.')
+            continue
+        new_time = keys[0] + len(keys) * step
+        if not m:
+            continue
+        m = tuple(m)
+        if m not in groups:
+            groups[m] = []
+            plan.append((groups[m], m))
+        groups[m].append(c)
+    return plan, new_time
+
+# apply the moves with one relative keyframe edit per run, on all channels that share them
+
+def applyRetimeMoves(moves, channels=None):
+    for first, last, offset in moves:
+        if channels and channels != [None]:
+            mc.keyframe(edit=True, time=(first, last), option='over',
+                        relative=True, timeChange=offset, at=channels)
+        else:
+            mc.keyframe(edit=True, time=(first, last), option='over',
+                        relative=True, timeChange=offset)
+
+# apply the whole plan with one setAttr per curve, writing the new times over each curve's moved keys.
+# the keys of every curve are fetched together, and a curve whose keys would pass over keys
+# outside the range falls back to relative moves, so maya can reorder them
+
+def applyRetimePlan(plan):
+    curves = []
+    curveMoves = []
+    for channels, moves in plan:
+        if channels and channels != [None]:
+            found = mc.keyframe(query=True, name=True, at=channels)
         else:
+            found = mc.keyframe(query=True, name=True)
+        for curve in found or []:
+            curves.append(curve)
+            curveMoves.append(moves)
+    if not curves:
+        return
+    # times and values come back interleaved, and index values start over at 0 for each curve
+    data = mc.keyframe(curves, query=True, timeChange=True, valueChange=True) or []
+    starts = [i for i, x in enumerate(
+        mc.keyframe(curves, query=True, indexValue=True) or []) if x == 0]
+    if len(starts) != len(curves):
+        for channels, moves in plan:
+            applyRetimeMoves(moves, channels=channels)
+        return
+    starts.append(len(data) // 2)
+    for i, (curve, moves) in enumerate(zip(curves, curveMoves)):
+        times = data[starts[i] * 2:starts[i + 1] * 2:2]
+        values = data[starts[i] * 2 + 1:starts[i + 1] * 2:2]
+        runs = sorted(moves)
+        firsts = [first for first, last, offset in runs]
+        newTimes = list(times)
+        for k, t in enumerate(times):
+            j = bisect.bisect_right(firsts, t + 0.0001) - 1
+            if j >= 0 and t <= runs[j][1] + 0.0001:
+                newTimes[k] = t + runs[j][2]
+        changed = [k for k, t in enumerate(times) if newTimes[k] != t]
+        if not changed:
+            continue
+        if any(b <= a for a, b in zip(newTimes, newTimes[1:])):
+            for first, last, offset in moves:
+                mc.keyframe(curve, edit=True, time=(first, last), option='over',
+                            relative=True, timeChange=offset)
+            continue
+        keyTimeValue = []
+        for k in range(changed[0], changed[-1] + 1):
+            keyTimeValue.extend((newTimes[k], values[k]))
+        mc.setAttr(curve + '.keyTimeValue[' + str(changed[0]) + ':' +
+                   str(changed[-1]) + ']', *keyTimeValue)
+
+# Re-time keys from first key by value selected, as one undo step
+
+def retimeSelectedKeys(*args):
+    with Transaction():
+        start = None
+        end = None
+        new_time = None
+        step = getStepTime()
+        if keyCount() != None:
+            displayWarning(
+                'Unable to re-time curves. Please select a channel and re-time on the timeline.')
+        else:
+            channels = getSelectedChannels()
             if checkRangeSelected():
                 start, end = getSeletedRange(start, end)
-                keys = getKeysInRange(start, end)
-                first_key = keys[0]
-                new_time = first_key
-                # first move keys out of the way
-                temp_keys = []
-                for k in keys:
-                    temp_time = k + 1000
-                    temp_keys.append(temp_time)
-                    moveKey(k, temp_time, option='over')
-                # retime keys from first key by value selected
-                new_time = first_key
-                for k in temp_keys:
-                    moveKey(k, new_time, option='over')
-                    new_time += step
+                plan, new_time = planRetime(start, end, step, channels)
+                applyRetimePlan(plan)
             else:
                 displayWarning('No keys on the timeline selected.')
-        if (new_time == None):
-            pass
-        else:
-            mc.currentTime(new_time)
+            if (new_time == None):
+                pass
+            else:
+                mc.currentTime(new_time)
 
 w = 50
 
@@ -53,32 +53,119 @@ website = 'jnmolina.com'
 def getChannelFromAnimCurve(curve, plugs=True):
     '''
     Finding the channel associated with a curve has gotten really complicated since animation layers.
-    This is a recursive function which walks connections from a curve until an animated channel is found.
+    This walks connections from a curve until an animated channel is found.
     '''
+    return getChannelsFromAnimCurves([curve], plugs=plugs)[0]
 
-    # we need to save the attribute for later.
-    attr = ''
-    if '.' in curve:
-        curve, attr = curve.split('.')
-
-    nodeType = mc.nodeType(curve)
-    if nodeType.startswith('animCurveT') or nodeType.startswith('animBlendNode'):
-        source = mc.listConnections(curve+'.output', source=False, plugs=plugs)
-        if not source and nodeType == 'animBlendNodeAdditiveRotation':
-            # if we haven't found a connection from .output, then it may be a node that uses outputX, outputY, etc.
-            # get the proper attribute by using the last letter of the input attribute, which should be X, Y, etc.
-            # if we're not returning plugs, then we wont have an attr suffix to use, so just use X.
-            attrSuffix = 'X'
-            if plugs:
-                attrSuffix = attr[-1]
-
-            source = mc.listConnections(
-                curve+'.output'+attrSuffix, source=False, plugs=plugs)
-        if source:
-            nodeType = mc.nodeType(source[0])
+
+# curve to channel results, cleared whenever a connection is made or broken, or a node is deleted or renamed
+_channelMemo = dict()
+_channelMemoCallbacks = list()
+
+
+def clearChannelMemo(*args):
+    _channelMemo.clear()
+
+
+def unwatchChannelMemo(*args):
+    '''
+    Removes the memo callbacks and clears it, this runs before a new scene or file is opened.
+    '''
+    for callback in _channelMemoCallbacks:
+        try:
+            OpenMaya.MMessage.removeCallback(callback)
+        except RuntimeError:
+            pass
+    del _channelMemoCallbacks[:]
+    clearChannelMemo()
+
+
+def _watchChannelMemo():
+    if _channelMemoCallbacks:
+        return
+    _channelMemoCallbacks.append(
+        OpenMaya.MDGMessage.addConnectionCallback(clearChannelMemo))
+    _channelMemoCallbacks.append(
+        OpenMaya.MDGMessage.addNodeRemovedCallback(clearChannelMemo, 'dependNode'))
+    _channelMemoCallbacks.append(
+        OpenMaya.MNodeMessage.addNameChangedCallback(OpenMaya.MObject(), clearChannelMemo))
+    for message in (OpenMaya.MSceneMessage.kBeforeNew, OpenMaya.MSceneMessage.kBeforeOpen):
+        _channelMemoCallbacks.append(
+            OpenMaya.MSceneMessage.addCallback(message, unwatchChannelMemo))
+
+
+def getChannelsFromAnimCurves(curves, plugs=True):
+    '''
+    Returns the animated channel for each curve in a list, in the same order, or None where there isn't one.
+    Animation layer blend nodes are walked breadth first, with one connection query for each level of the graph.
+    Results are memoized until the graph changes.
+    '''
+
+    _watchChannelMemo()
+
+    result = [None]*len(curves)
+    # curves passed in more than once are only walked once
+    first = dict()
+    # walk the plugs of every curve that isn't memoized yet, as index, node, attr, node type
+    frontier = list()
+    for i, c in enumerate(curves):
+        if c in first:
+            continue
+        if (c, plugs) in _channelMemo:
+            first[c] = i
+            result[i] = _channelMemo[(c, plugs)]
+            continue
+        first[c] = i
+        node, _, attr = c.partition('.')
+        frontier.append((i, node, attr, None))
+
+    while frontier:
+        # one query for the whole level, only the first connection of each plug is used
+        destinations = dict()
+        connections = mc.listConnections(list(set(n+'.output' for i, n, a, t in frontier)),
+                                         source=False, plugs=True, connections=True) or []
+        for j in range(0, len(connections), 2):
+            destinations.setdefault(connections[j], connections[j+1])
+
+        # if we haven't found a connection from .output, then it may be a node that uses outputX, outputY, etc.
+        # get the proper attribute by using the last letter of the input attribute, which should be X, Y, etc.
+        sources = list()
+        for i, n, a, t in frontier:
+            if n+'.output' not in destinations and t == 'animBlendNodeAdditiveRotation':
+                sources.append(n+'.output'+(a[-1] if a else 'X'))
+            else:
+                sources.append(n+'.output')
+        missing = list(set(x for x in sources
+                           if x not in destinations and not x.endswith('.output')))
+        if missing:
+            connections = mc.listConnections(missing, source=False,
+                                             plugs=True, connections=True) or []
+            for j in range(0, len(connections), 2):
+                destinations.setdefault(connections[j], connections[j+1])
+
+        nodeTypes = dict()
+        if destinations:
+            showType = mc.ls(list(set(x.split('.')[0]
+                                      for x in destinations.values())), showType=True) or []
+            nodeTypes = dict(zip(showType[::2], showType[1::2]))
+
+        nextFrontier = list()
+        for (i, n, a, t), source in zip(frontier, sources):
+            if source not in destinations:
+                continue
+            node, _, attr = destinations[source].partition('.')
+            nodeType = nodeTypes.get(node) or mc.nodeType(node)
             if nodeType.startswith('animCurveT') or nodeType.startswith('animBlendNode'):
-                return getChannelFromAnimCurve(source[0], plugs=plugs)
-            return source[0]
+                nextFrontier.append((i, node, attr, nodeType))
+            else:
+                result[i] = destinations[source] if plugs else node
+        frontier = nextFrontier
+
+    for i, c in enumerate(curves):
+        result[i] = result[first[c]]
+        _channelMemo[(c, plugs)] = result[i]
+    return result
+
 
 def getSelectedAnimLayers():
     '''
@@ -90,6 +177,70 @@ def getSelectedAnimLayers():
             layers.append(each)
     return layers
 
+MAYA_VERSION = mm.eval('getApplicationVersionAsFloat')
+
+class UndoChunk():
+    '''
+    In versions of maya before 2011, python doesn't always undo properly, so in
+    some cases we have to manage the undo queue ourselves.
+    '''
+
+    def __init__(self, force=False):
+        self.force = force
+
+    def __enter__(self):
+        '''open the undo chunk'''
+        if self.force or MAYA_VERSION < 2011:
+            self.force = True
+            mc.undoInfo(openChunk=True)
+
+    def __exit__(self, *args):
+        '''close the undo chunk'''
+        if self.force:
+            mc.undoInfo(closeChunk=True)
+
+
+class Transaction():
+    '''
+    Wraps a whole operation in one undo chunk, and suspends refresh and turns off autokey
+    once for the duration instead of around every edit. Nested transactions are absorbed
+    by the outermost one.
+    '''
+
+    depth = 0
+
+    def __enter__(self):
+
+        if Transaction.depth:
+            Transaction.depth += 1
+            return self
+
+        self.undoChunk = UndoChunk(force=True)
+        self.undoChunk.__enter__()
+        self.resetAutoKey = None
+        try:
+            self.resetAutoKey = mc.autoKeyframe(query=True, state=True)
+            mc.autoKeyframe(state=False)
+            mc.refresh(suspend=True)
+        except:
+            if self.resetAutoKey is not None:
+                mc.autoKeyframe(state=self.resetAutoKey)
+            self.undoChunk.__exit__()
+            raise
+        Transaction.depth += 1
+        return self
+
+
+    def __exit__(self, *args):
+
+        Transaction.depth -= 1
+        if Transaction.depth:
+            return
+
+        mc.refresh(suspend=False)
+        mc.autoKeyframe(state=self.resetAutoKey)
+        self.undoChunk.__exit__(*args)
+
 # JNM scripts
 
 def displayWarning(text):
@@ -111,59 +262,85 @@ def keyCount(*args):
     count = mc.keyframe(query=True, timeChange=True, selected=True)
     return count
 
+# get the anim layer to key on, None if more than one is selected
+def getKeyLayer(*args):
+    animlayers = getSelectedAnimLayers()
+    if len(animlayers) > 1:
+        displayWarning('Please select only one anim layer.')
+        return None
+    if animlayers:
+        return animlayers[0]
+    if mc.animLayer('BaseAnimation', query=True, exists=True):
+        return 'BaseAnimation'
+    return ''
+
+# insert all the frames of a plan at once, channels that share the same frames are keyed together
+def insertKeys(plan, anim_layer=''):
+    for times, plugs in plan:
+        if anim_layer == '':
+            mc.setKeyframe(plugs, insert=True, time=list(times))
+        else:
+            mc.setKeyframe(plugs, insert=True, time=list(times),
+                           animLayer=anim_layer)
+
+# Set keys every step frames between the selected keys, as one undo step
 def setKeysBy(*args):
-    attr = None
-    anim_layer = ''
-    if objSelected():
-        if keyCount() != None:
-            keyCurve = mc.keyframe(query=True, name=True)
-            for kc in keyCurve:
-                keyTimes = mc.keyframe(kc, query=True, selected=True)
-                sel, attr = getChannelFromAnimCurve(kc).split('.')
-                start = int(keyTimes[0])
-                end = int(keyTimes[-1])
+    with Transaction():
+        if objSelected():
+            if keyCount() != None:
+                anim_layer = getKeyLayer()
+                if anim_layer == None:
+                    return
                 step = getStepTime()
-                animlayers = getSelectedAnimLayers()
-                if len(animlayers) > 1:
-                    displayWarning('Please select only one anim layer.')
-                else:
-                    if animlayers:
-                        anim_layer = animlayers[0]
-                    else:
-                        if mc.animLayer('BaseAnimation', query=True, exists=True):
-                            anim_layer = 'BaseAnimation'
-                        else:
-                            anim_layer = ''
-                for x in range(start, end, step):
-                    if anim_layer == '':
-                        mc.setKeyframe(insert=True, t=x, attribute=attr)
-                    else:
-                        mc.setKeyframe(insert=True, t=x,
-                                       attribute=attr, animLayer=anim_layer)
+                plan = []
+                frames = {}
+                keyCurve = mc.keyframe(query=True, name=True)
+                for kc in keyCurve:
+                    keyTimes = mc.keyframe(kc, query=True, selected=True)
+                    if not keyTimes:
+                        continue
+                    times = tuple(range(int(keyTimes[0]), int(keyTimes[-1]), step))
+                    if not times:
+                        continue
+                    if times not in frames:
+                        frames[times] = []
+                        plan.append((times, frames[times]))
+                    frames[times].append(kc)
+                # resolve every curve's channel in one pass
+                curves = [kc for times, kcs in plan for kc in kcs]
+                channels = dict(zip(curves, getChannelsFromAnimCurves(curves)))
+                # skip curves that aren't connected to a channel
+                plan = [(times, [channels[kc] for kc in kcs if channels[kc]]) for times, kcs in plan]
+                plan = [(times, plugs) for times, plugs in plan if plugs]
+                insertKeys(plan, anim_layer)
+            else:
+                displayWarning('No keys selected.')
+
+# group sorted key indices into (first, last) ranges for selectKey
+def getIndexRanges(indices):
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
         else:
-            displayWarning('No keys selected.')
+            ranges.append([i, i])
+    return [tuple(r) for r in ranges]
 
+# Select every step key of the selected keys, on every selected curve
 def selectKeysBy(*args):
-    attr = None
-    step = getStepTime()
     if objSelected():
         if keyCount() != None:
+            step = getStepTime()
+            plan = []
             keyCurve = mc.keyframe(query=True, name=True)
-            if len(keyCurve) > 1:
-                displayWarning('Please select only one anim curve.')
-            else:
-                for kc in keyCurve:
-                    keyTimes = mc.keyframe(kc, query=True, selected=True)
-                    sel, attr = getChannelFromAnimCurve(kc).split('.')
-                    start = int(keyTimes[0])
-                    end = int(keyTimes[-1])
-                    step = getStepTime()
-                    mc.selectKey(clear=True)
-                    c = 0
-                    while c < len(keyTimes):
-                        mc.selectKey(sel, keyframe=True, time=(
-                            keyTimes[c], keyTimes[c]), attribute=attr, add=True)
-                        c = c+step
+            for kc in keyCurve:
+                indices = mc.keyframe(kc, query=True, selected=True,
+                                      indexValue=True)
+                if indices:
+                    plan.append((kc, getIndexRanges(sorted(indices)[::step])))
+            mc.selectKey(clear=True)
+            for kc, ranges in plan:
+                mc.selectKey(kc, keyframe=True, index=ranges, add=True)
         else:
             displayWarning('No keys selected.')
 